@@ -0,0 +1,94 @@
+"""
+Measure the per call overhead of the call_api middleware chain
+
+Requests go to a stub transport that returns a canned response without any network access,
+so the timings are only the python overhead of call_api itself. Compares:
+- baseline: call_api as it was before the middleware chain was added, on the same client
+- empty chain: call_api with no middleware
+- 1 / 5 layers: call_api with pass-through Middleware layers
+
+Usage:
+    python benchmarks/bench_middleware.py [--calls 5000]
+"""
+import argparse
+import functools
+import os
+import sys
+import time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import jupyter_oauth2_api as auth
+
+class StubAdapter(requests.adapters.BaseAdapter):
+    def send(self, request, **kwargs):
+        import io
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = 'OK'
+        r._content = b'{"id": 1}'
+        r.raw = io.BytesIO(r._content)
+        r.headers['Content-Type'] = 'application/json'
+        r.url = request.url
+        r.request = request
+        return r
+    def close(self):
+        pass
+
+def make_client():
+    client = auth.AuthClient({"api_audience": 'http://stub/api'})
+    client.access_token = 'TOKEN'
+    client.session.mount('http://', StubAdapter())
+    #Skip proxy / netrc lookups from the environment, they dominate the timing
+    client.session.trust_env = False
+    return client
+
+def baseline_call_api(self, url, data=None, throw=False, prefix=None):
+    #call_api as it was before the middleware chain
+    if self._machine():
+        self._ensure_token()
+    elif self._pending is not None:
+        self._await_login()
+    method, url, headersAPI, body = self._prepare(url, data, prefix)
+
+    if self._http2():
+        r = self.http2_client.request(method, url, headers=headersAPI, content=body)
+    else:
+        r = self.session.request(method, url, headers=headersAPI, data=body)
+    self._record(r)
+    return self._check(r, throw)
+
+def timeit(variants, calls, repeats=7):
+    """Best time per call in microseconds for each variant, runs are interleaved to even out noise"""
+    for name, fn in variants:
+        for i in range(min(1000, calls)):
+            fn()
+    best = {}
+    for repeat in range(repeats):
+        for name, fn in variants:
+            start = time.perf_counter()
+            for i in range(calls):
+                fn()
+            elapsed = (time.perf_counter() - start) / calls * 1e6
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return [(name, best[name]) for name, fn in variants]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=5000)
+    args = parser.parse_args()
+
+    client = make_client()
+    variants = [("baseline", lambda: baseline_call_api(client, '/task/')),
+                ("empty chain", lambda: client.call_api('/task/'))]
+    for layers in [1, 5]:
+        c = make_client()
+        for i in range(layers):
+            c.add_middleware(auth.Middleware())
+        variants.append(("{} layer{}".format(layers, 's' if layers > 1 else ''), functools.partial(c.call_api, '/task/')))
+    results = timeit(variants, args.calls)
+
+    base = results[0][1]
+    print("{:<12} {:>12} {:>10}".format('chain', 'us/call', 'vs base'))
+    for name, us in results:
+        print("{:<12} {:>12.2f} {:>+9.1f}%".format(name, us, (us - base) / base * 100))
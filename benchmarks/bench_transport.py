@@ -0,0 +1,79 @@
+"""
+Compare the requests and HTTP/2 (httpx) transports for bursts of concurrent API calls
+
+Usage:
+    python benchmarks/bench_transport.py --url https://MYSITE/api/projects/ --token ACCESS_TOKEN
+
+HTTP/2 is only negotiated over https, so use a real API endpoint to see the multiplexing benefit.
+If --url is omitted a local HTTP/1.1 server is used, which only measures transport overhead.
+(The token can also be passed in env var JUPYTER_OAUTH2_ACCESS_TOKEN)
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import jupyter_oauth2_api as auth
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 65536 #Send headers and body together
+    def do_GET(self):
+        body = b'{"id": 1, "status": 40, "progress": 1.0}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+
+def local_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:%d/api/task/" % server.server_address[1]
+
+async def burst(client, url, count, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    async def one():
+        async with sem:
+            r = await client.call_api_async(url)
+            return r.status_code
+    return await asyncio.gather(*[one() for i in range(count)])
+
+def run(transport, url, token, count, concurrency):
+    client = auth.AuthClient({"api_audience": '', "transport": transport, "pool_size": concurrency})
+    client.access_token = token
+    async def main():
+        #Warm up the connection(s) first
+        await client.call_api_async(url)
+        start = time.perf_counter()
+        codes = await burst(client, url, count, concurrency)
+        return time.perf_counter() - start, codes
+    elapsed, codes = asyncio.run(main())
+    errors = sum(1 for c in codes if c >= 400)
+    version = ''
+    if client._http2():
+        version = client.http2_client.get(url).http_version
+    return elapsed, errors, version or 'HTTP/1.1'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='API endpoint to GET, default is a local test server')
+    parser.add_argument('--token', default=os.getenv('JUPYTER_OAUTH2_ACCESS_TOKEN', ''))
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100])
+    args = parser.parse_args()
+    url = args.url or local_server()
+
+    print("{:<10} {:>11} {:>9} {:>9} {:>9} {:>7}  {}".format(
+        'transport', 'concurrency', 'requests', 'seconds', 'req/s', 'errors', 'protocol'))
+    for concurrency in args.concurrency:
+        for transport in ['requests', 'http2']:
+            elapsed, errors, version = run(transport, url, args.token, args.requests, concurrency)
+            print("{:<10} {:>11} {:>9} {:>9.3f} {:>9.1f} {:>7}  {}".format(
+                transport, concurrency, args.requests, elapsed, args.requests / elapsed, errors, version))
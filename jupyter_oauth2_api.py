@@ -45,6 +45,12 @@ data = {'name': 'My Project', 'description': 'Created by API with token'}
 r = auth.call_api('/projects/', data)
 print(r.json())
 
+#Tokens for several APIs can be held at once with separate clients,
+#which can also be shared between threads
+tiles = auth.AuthClient(tiles_config)
+await tiles.connect()
+r = tiles.call_api('/layers/')
+
 ```
 """
 
@@ -55,16 +61,33 @@ import logging
 import datetime
 import time
 import sys
+import threading
+import types
+import functools
+import inspect
+import jupyter_oauth2_store
+import jupyter_oauth2_stream
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+def _json_codec():
+    """Default json (dumps, loads), always the json module
+    (orjson is only used if chosen with set_json_codec(), it rejects int dict keys and NaN / Infinity
+    and decodes ints over 64 bits as floats)
+    """
+    return _stdlib_dumps, json.loads
 
-baseurl = ''      #Base jupyterhub url
-access_token = '' #Store the received token here
-token_data = ''   #All the received token data
-port = None       #Server port, default is to automatically assign
-nonce = ''        #For verifying token
-_server = None     #Server to receive token
+def _accept_encoding():
+    """Response compression the installed urllib3 can decode (adds br / zstd if brotli / zstandard installed)"""
+    try:
+        from urllib3.util.request import ACCEPT_ENCODING
+        return ACCEPT_ENCODING
+    except ImportError:
+        return 'gzip,deflate'
 
-#Settings, to be provided before use
-settings = {
+#Default settings, each AuthClient gets its own copy to be provided before use
+_default_settings = {
     "default_baseurl": 'https://JUPYTERHUB_URL/user-redirect',
     "api_audience": 'https://MYSITE/api',
     "api_client_id": 'CLIENT_ID_HERE',
@@ -72,9 +95,2146 @@ settings = {
     "api_authurl": 'MY_OAUTH2_PROVIDER_URL',
     #"token_prefix": 'JWT',
     "token_prefix": 'Bearer',
+    #Set to 'client_credentials' for non-interactive (machine to machine) login with a client secret
+    "auth_flow": 'browser',
+    "api_client_secret": '',
+    #Renew tokens this many seconds before they expire
+    "token_leeway": 60,
+    "pool_size": 16,
+    #Gzip POST bodies at least this size (the API server must accept Content-Encoding: gzip)
+    "compress_requests": False,
+    "compress_min_bytes": 16384,
+    #'requests' or 'http2' to multiplex concurrent calls over one connection per host
+    #(http2 requires httpx and h2: pip install httpx[http2], falls back to requests if not installed)
+    "transport": 'requests',
+    #Start connecting to the auth provider and api in the background when setup() is called
+    "warmup": False,
+    #Get the provider endpoints from its .well-known/openid-configuration, otherwise Auth0 paths are used
+    "discovery": True,
+    #Discovery url, default is "api_authurl" + '/.well-known/openid-configuration'
+    "discovery_url": '',
+    #Seconds to cache provider configuration if the response has no caching headers
+    "discovery_ttl": 86400,
+    #Save tokens in the user cache dir so command line tools can reuse them (see jupyter-oauth2-token)
+    "token_store": True,
     "provided" : False
 }
 
+class AuthClient:
+    """
+    OAuth2 client holding the settings, token and connection pool for a single API audience
+
+    The module level functions operate on a shared default instance, create more instances
+    to hold tokens for several audiences in the same process, eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... webodm = auth.AuthClient({"api_audience": 'https://MYSITE/api', ...})
+    ... tiles = auth.AuthClient({"api_audience": 'https://TILES/api', ...})
+    ... await webodm.connect()
+    ... await tiles.connect()
+    ... r = tiles.call_api('/layers/')
+
+    Parameters
+    ----------
+    config: dict
+        The configuration dict, if omitted setup() must be called before use
+    """
+    def __init__(self, config=None):
+        self.settings = dict(_default_settings)
+        self.baseurl = ''      #Base jupyterhub url
+        self._access_token = '' #Store the received token here
+        self._token_data = ''   #All the received token data
+        self.expires_at = None #Token expiry timestamp, if known
+        self._token_file = None   #Token written here when shared with other processes
+        self._token_source = None #Token read from here in worker processes
+        self._token_record = None
+        self.port = None       #Server port, default is to automatically assign
+        self.nonce = ''        #For verifying token
+        self._server = None    #Server to receive token
+        self._server_loop = None #Event loop of server running in background thread
+        self._pending = None   #Background login in progress
+        self._batches = {}     #Browser batches awaiting results
+        self._warmup = None    #Background warm-up started by setup()
+        self.provider_metadata = None #OpenID provider configuration
+        self.jwks = None       #Provider token signing keys
+        self._token_event = threading.Event()
+        self._session = None   #Connection pool for API calls
+        self._h2 = None        #HTTP/2 transport available, None until checked
+        self._h2_client = None
+        self._h2_async = {}    #HTTP/2 async clients, one per event loop
+        self._middleware = []  #Request/response middleware, see add_middleware()
+        self._chain = self._chain_async = None
+        self.json_dumps, self.json_loads = _json_codec()
+        self._metrics_lock = threading.Lock()
+        self.reset_metrics()
+        #Guards the token and session state, API calls may be made from many threads
+        self._lock = threading.RLock()
+        if config is not None:
+            self.setup(config)
+
+    def setup(self, config=None):
+        """Pass a dict with the authentication settings
+
+        eg:
+        >>> import jupyter_oauth2_api as auth
+        ... auth.setup({"default_baseurl": 'https://JUPYTERHUB_URL/user-redirect',
+        ...    "api_audience": 'https://MYSITE/api',
+        ...    "api_client_id": 'CLIENT_ID_HERE',
+        ...    "api_scope": 'openid profile email',
+        ...    "api_authurl": 'MY_OAUTH2_PROVIDER_URL'
+         ...   })
+
+        Parameters
+        ----------
+        config: dict
+            The configuration dict
+        """
+        settings = self.settings
+        if config is None:
+            #Try and load from env variables
+            #(use os.environ dict which throws exception if key not found)
+            try:
+                settings["auth_flow"] = os.getenv('JUPYTER_OAUTH2_FLOW', settings["auth_flow"])
+                settings["api_client_secret"] = os.getenv('JUPYTER_OAUTH2_CLIENT_SECRET', settings["api_client_secret"])
+                #Batch jobs using client credentials don't need to be running in jupyterhub
+                if settings["auth_flow"] != 'client_credentials' or 'JUPYTERHUB_URL' in os.environ:
+                    settings["default_baseurl"] = os.environ['JUPYTERHUB_URL'] + '/user-redirect'
+                settings["api_audience"] = os.environ['JUPYTER_OAUTH2_API_AUDIENCE']
+                settings["api_client_id"] = os.environ['JUPYTER_OAUTH2_CLIENT_ID']
+                settings["api_scope"] = os.getenv('JUPYTER_OAUTH2_SCOPE', settings["api_scope"])
+                settings["api_authurl"] = os.environ['JUPYTER_OAUTH2_AUTH_PROVIDER_URL']
+                settings["token_prefix"] = os.getenv('JUPYTER_OAUTH2_PREFIX', settings["token_prefix"])
+                settings["transport"] = os.getenv('JUPYTER_OAUTH2_TRANSPORT', settings["transport"])
+                settings["warmup"] = os.getenv('JUPYTER_OAUTH2_WARMUP', str(settings["warmup"])).lower() in ('1', 'true', 'yes')
+                settings["token_store"] = os.getenv('JUPYTER_OAUTH2_TOKEN_STORE', str(settings["token_store"])).lower() in ('1', 'true', 'yes')
+                settings["provided"] = True
+            except Exception as e:
+                logging.error("Error loading settings from env: %s", str(e))
+        else:
+            settings.update(config)
+            settings["provided"] = True
+
+        if settings["provided"] and settings["warmup"] and self._token_source is None:
+            #Only once for the configured hosts, setup() is also called by connect(config)
+            hosts = (settings["api_authurl"], settings["api_audience"])
+            if self._warmup is None or self._warmup.hosts != hosts:
+                self.warmup()
+
+    def refresh(self, refresh_token=None):
+        """
+        Get a new access token using a refresh token
+
+        See the module level refresh() for details, parameters are the same
+        """
+        self._check_settings()
+        settings = self.settings
+        if refresh_token is None:
+            refresh_token = (self.token_data or {}).get("refresh_token")
+        if not refresh_token:
+            raise(Exception("No refresh token available, login with the 'offline_access' scope to get one"))
+        data = {
+            "grant_type": "refresh_token",
+            "client_id": settings['api_client_id'],
+            "refresh_token": refresh_token,
+        }
+        if settings["api_client_secret"]:
+            data["client_secret"] = settings["api_client_secret"]
+        r = self.session.post(self.endpoint('token_endpoint'), data=data)
+        token_json = r.json()
+        if r.status_code >= 400 or "access_token" not in token_json:
+            logging.error("Refresh token error response: %s %s", r.status_code, token_json)
+            raise(Exception("Error response from token request!"))
+        #Keep using the same refresh token if the provider doesn't issue a new one
+        token_json.setdefault("refresh_token", refresh_token)
+        self._set_token(token_json)
+
+    def warmup(self):
+        """
+        Prepare for the first login and API call in the background
+
+        See the module level warmup() for details
+
+        Returns
+        -------
+        Warmup
+            handle with the timing of each step
+        """
+        self._check_settings()
+        settings = self.settings
+        w = Warmup((settings["api_authurl"], settings["api_audience"]))
+        self._warmup = w
+
+        def api():
+            w._step('resolve_api', lambda: _resolve(settings["api_audience"]))
+            w._step('connect_api', lambda: self._preconnect(settings["api_audience"]))
+
+        def provider():
+            w._step('resolve_auth', lambda: _resolve(settings["api_authurl"]))
+            #Also connects to the provider, ready for the token and userinfo requests
+            w._step('metadata', self.discover)
+            w._step('jwks', self._fetch_jwks)
+            if self._machine():
+                w._step('token', self.client_connect)
+
+        def listener():
+            w._step('listener', lambda: self._start_listener(background=True))
+
+        steps = [api, provider]
+        if not self._machine() and is_notebook():
+            steps.append(listener)
+        for step in steps:
+            t = threading.Thread(target=step, name="jupyter_oauth2_warmup", daemon=True)
+            t.start()
+            w._threads.append(t)
+        return w
+
+    def _preconnect(self, url):
+        """Open a connection to the url host and leave it in the pool"""
+        if self._http2():
+            self.http2_client.head(url)
+        else:
+            self.session.head(url, timeout=30)
+
+    def discover(self, refresh=False):
+        """
+        Get the OpenID provider configuration, from the cache if still valid
+
+        Cached in memory and on disk for the time allowed by the response caching headers
+        (Cache-Control max-age / Expires, or "discovery_ttl" seconds if there are none),
+        stale entries are revalidated with If-None-Match / If-Modified-Since
+
+        Parameters
+        ----------
+        refresh: bool
+            Ignore the cached copy and fetch again
+
+        Returns
+        -------
+        dict
+            provider metadata, empty if discovery is disabled or not supported by the provider
+        """
+        settings = self.settings
+        if not settings["discovery"]:
+            return {}
+        url = settings["discovery_url"] or settings["api_authurl"].rstrip('/') + '/.well-known/openid-configuration'
+        entry = _discovery.get(url)
+        if entry is None or refresh or entry["expires"] <= time.time():
+            with _discovery_lock:
+                entry = _discovery.get(url)
+                if entry is None:
+                    entry = jupyter_oauth2_store.read_json(jupyter_oauth2_store.cache_path('discovery', url))
+                if entry is None or refresh or entry["expires"] <= time.time():
+                    entry = self._fetch_discovery(url, None if refresh else entry)
+                _discovery[url] = entry
+        self.provider_metadata = entry["metadata"]
+        return self.provider_metadata
+
+    def _fetch_discovery(self, url, entry):
+        """Fetch or revalidate the provider configuration, returns the new cache entry"""
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            r = self.session.get(url, headers=headers, timeout=30)
+        except requests.RequestException as e:
+            if entry:
+                #Use the stale copy until the provider can be reached
+                logging.warning("Provider discovery failed, using cached configuration: %s", e)
+                return dict(entry, expires=time.time() + 60)
+            raise
+        if r.status_code == 304 and entry:
+            metadata = entry["metadata"]
+        elif r.status_code == 200:
+            metadata = r.json()
+        else:
+            #Provider doesn't support discovery, use the default paths, check again later
+            logging.info("Provider discovery unavailable (%s), using default endpoints", r.status_code)
+            return {"metadata": {}, "expires": time.time() + 300}
+
+        expires, store = _cache_expiry(r.headers, self.settings["discovery_ttl"])
+        entry = {"metadata": metadata, "expires": expires,
+                 "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        path = jupyter_oauth2_store.cache_path('discovery', url)
+        if store:
+            try:
+                jupyter_oauth2_store.write_json(path, entry)
+            except OSError as e:
+                logging.debug("Unable to cache provider configuration: %s", e)
+        return entry
+
+    def endpoint(self, name):
+        """
+        Get a provider endpoint url from the discovered configuration
+
+        Parameters
+        ----------
+        name: str
+            metadata key, eg: 'token_endpoint', 'authorization_endpoint', 'device_authorization_endpoint',
+            'userinfo_endpoint', 'jwks_uri'
+
+        Returns
+        -------
+        str
+            endpoint url, the Auth0 path on "api_authurl" if not discovered
+        """
+        try:
+            metadata = self.discover()
+        except Exception as e:
+            logging.warning("Provider discovery failed, using default endpoints: %s", e)
+            metadata = {}
+        url = metadata.get(name)
+        if url:
+            return url
+        return self.settings["api_authurl"] + _default_endpoints[name]
+
+    def _fetch_jwks(self):
+        """Get the provider token signing keys"""
+        url = self.endpoint('jwks_uri')
+        r = self.session.get(url, timeout=30)
+        r.raise_for_status()
+        self.jwks = r.json()
+        return self.jwks
+
+    def _check_settings(self):
+        if not self.settings['provided']:
+            #Never print secrets
+            settings = {k: ('********' if 'secret' in k and v else v) for k, v in self.settings.items()}
+            print('Please call .setup(dict) to configure before use, defaults are not usable:\n', settings)
+            raise(Exception('Settings not provided'))
+
+    def _scope(self, scope=""):
+        """Configured scopes plus any additional scopes requested,
+        (does not modify the settings so repeated calls don't keep appending)
+        """
+        if scope:
+            return self.settings["api_scope"] + " " + scope
+        return self.settings["api_scope"]
+
+    @property
+    def session(self):
+        """Connection pool used for API calls, shared by all threads using this client"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    size = self.settings.get("pool_size", 16)
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers['Accept-Encoding'] = _accept_encoding()
+                    self._session = session
+        return self._session
+
+    @property
+    def access_token(self):
+        """The current access token"""
+        if self._token_source is not None:
+            self._sync_token()
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, value):
+        self._access_token = value
+
+    @property
+    def token_data(self):
+        """All the received token data"""
+        if self._token_source is not None:
+            self._sync_token()
+        return self._token_data
+
+    @token_data.setter
+    def token_data(self, value):
+        self._token_data = value
+
+    def _http2(self):
+        """Check if the HTTP/2 transport is selected and available"""
+        if self.settings["transport"] != 'http2':
+            return False
+        if self._h2 is None:
+            try:
+                import httpx
+                import h2
+                self._h2 = True
+            except ImportError:
+                logging.warning("HTTP/2 transport requires httpx and h2 (pip install httpx[http2]), using requests")
+                self._h2 = False
+        return self._h2
+
+    def _limits(self):
+        import httpx
+        size = self.settings.get("pool_size", 16)
+        return httpx.Limits(max_connections=size, max_keepalive_connections=size)
+
+    @property
+    def http2_client(self):
+        """HTTP/2 connection pool used for API calls when "transport" is 'http2'"""
+        if self._h2_client is None:
+            with self._lock:
+                if self._h2_client is None:
+                    import httpx
+                    self._h2_client = httpx.Client(http2=True, follow_redirects=True, limits=self._limits())
+        return self._h2_client
+
+    def _http2_async_client(self):
+        """HTTP/2 async client for the running event loop (clients can't be shared between loops)"""
+        import asyncio
+        import httpx
+        loop = asyncio.get_running_loop()
+        client = self._h2_async.get(loop)
+        if client is None:
+            with self._lock:
+                #Drop clients for loops that have been closed
+                self._h2_async = {l: c for l, c in self._h2_async.items() if not l.is_closed()}
+                client = httpx.AsyncClient(http2=True, follow_redirects=True, limits=self._limits())
+                self._h2_async[loop] = client
+        return client
+
+    def _set_token(self, data, expires_at=None):
+        """Store received token data and work out when it expires
+        (pass expires_at unless the token was just issued, expires_in counts from when it was issued)
+        """
+        with self._lock:
+            self._token_data = data
+            self._access_token = data['access_token'] if data else ''
+            self.expires_at = expires_at
+            if data:
+                if expires_at is not None:
+                    pass
+                elif 'expires_in' in data:
+                    self.expires_at = time.time() + int(data['expires_in'])
+                elif isinstance(data.get('id_token'), dict) and 'exp' in data['id_token']:
+                    self.expires_at = int(data['id_token']['exp'])
+                #Pass on to worker processes and command line tools
+                if self._token_file is None and self.settings["token_store"] and self._token_source is None:
+                    self._token_file = jupyter_oauth2_store.TokenFile(self._token_path())
+                if self._token_file is not None:
+                    try:
+                        self._token_file.save(data, self.expires_at)
+                    except OSError as e:
+                        logging.warning("Unable to save token to %s: %s", self._token_file.path, e)
+                self._token_event.set()
+            else:
+                self._token_event.clear()
+
+    def _sync_token(self):
+        """Pick up the token shared by another process, including renewals"""
+        with self._lock:
+            record = self._token_source.load()
+            if record is not self._token_record:
+                self._token_record = record
+                self._token_data = record["token_data"] if record else ''
+                self._access_token = self._token_data['access_token'] if self._token_data else ''
+                self.expires_at = record["expires_at"] if record else None
+
+    def _token_path(self):
+        #Default token file for this audience, client id and provider
+        settings = self.settings
+        return jupyter_oauth2_store.token_path(settings["api_audience"], settings["api_client_id"], settings["api_authurl"])
+
+    def token_handle(self, path=None):
+        """
+        Share the token with worker processes through a file
+
+        The returned handle is small and can be pickled and passed to process pool or dask tasks,
+        workers read the token lazily and pick up any renewals made by this client.
+        (The file must be visible to the workers, ie: same machine or a shared home directory)
+
+        Parameters
+        ----------
+        path: str
+            file to store the token in, default is a file in the user cache dir for the api audience and client
+
+        Returns
+        -------
+        TokenHandle
+            handle to pass to workers
+        """
+        with self._lock:
+            if self._token_source is not None:
+                #Already reading from a shared token, pass the same one on
+                return TokenHandle(self._token_source.path, self.settings)
+            if path is None:
+                path = self._token_path()
+            if self._token_file is None or self._token_file.path != path:
+                self._token_file = jupyter_oauth2_store.TokenFile(path)
+            if self._token_data:
+                self._token_file.save(self._token_data, self.expires_at)
+        return TokenHandle(path, self.settings)
+
+    def use_token_file(self, path):
+        """
+        Read the token from a file shared by another process instead of logging in
+
+        Parameters
+        ----------
+        path: str
+            token file, see token_handle()
+        """
+        with self._lock:
+            self._token_source = jupyter_oauth2_store.TokenFile(path)
+            self._token_record = None
+
+    def token_expired(self):
+        """
+        Check if the current token is missing or expired
+
+        Returns
+        -------
+        boolean
+            True if there is no usable token
+        """
+        with self._lock:
+            if not self.token_data:
+                return True
+            if self.expires_at is None:
+                return False
+            return datetime.datetime.fromtimestamp(self.expires_at) <= datetime.datetime.now(tz=None)
+
+    def _machine(self):
+        #(Workers reading a shared token never login themselves)
+        return self.settings["auth_flow"] == 'client_credentials' and self._token_source is None
+
+    def _ensure_token(self):
+        """Get or renew the token before an API call when using client credentials"""
+        expires_at = self.expires_at
+        if not self._access_token or (expires_at is not None and
+                expires_at - self.settings["token_leeway"] <= time.time()):
+            self.client_connect()
+
+    def client_connect(self, config=None, scope=""):
+        """
+        Authenticate with the OAuth2 id provider using the client credentials flow
+
+        See the module level client_connect() for details, parameters are the same
+        """
+        if config is not None:
+            self.setup(config)
+        self._check_settings()
+        settings = self.settings
+        if not settings["api_client_secret"]:
+            raise(Exception("Client credentials flow requires api_client_secret (or JUPYTER_OAUTH2_CLIENT_SECRET)"))
+
+        key = (settings["api_authurl"], settings["api_client_id"], settings["api_audience"], scope)
+        leeway = settings["token_leeway"]
+        #Only one thread fetches each token at a time, others use the result
+        #(locked per key so other clients / audiences aren't held up)
+        with _machine_lock:
+            key_lock = _machine_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            cached = _machine_tokens.get(key)
+            if cached is None or cached[1] - leeway <= time.time():
+                data = {
+                    "grant_type": "client_credentials",
+                    "client_id": settings['api_client_id'],
+                    "client_secret": settings['api_client_secret'],
+                    "audience": settings['api_audience'],
+                }
+                if scope:
+                    data["scope"] = scope
+                r = self.session.post(self.endpoint('token_endpoint'), data=data)
+                token_json = r.json()
+                if r.status_code >= 400 or "access_token" not in token_json:
+                    logging.error("Client credentials error response: %s %s", r.status_code, token_json)
+                    raise(Exception("Error response from token request!"))
+                expires_at = time.time() + int(token_json.get("expires_in", 86400))
+                cached = (token_json, expires_at)
+                _machine_tokens[key] = cached
+
+        self._set_token(cached[0], cached[1])
+
+    def get_url(self):
+        """Attempt to get the Jupyter base url
+
+        This is difficult on the server side without callback from the browser client
+        Needs to be set in env var ideally, can be overridden by settings above
+        """
+        self._check_settings()
+        import subprocess
+
+        #Get from env if set
+        server_url = os.getenv('JUPYTERHUB_URL')
+        if server_url:
+            self.baseurl = server_url + '/user-redirect'
+        else:
+            result = subprocess.run('jupyter notebook list --json'.split(), stdout=subprocess.PIPE)
+            res = result.stdout.decode().split('\n')
+
+            #Just take the longest path that is above os.getcwd() - not 100% reliable though
+            cwd = os.getcwd()
+            lastlen = 0
+            for r in res:
+                if not len(r): break
+                nbc = json.loads(r)
+                d = nbc["notebook_dir"]
+                if d in cwd and len(d) > lastlen:
+                    nbconfig = nbc
+                    lastlen = len(d)
+
+            if nbconfig['hostname'] == '0.0.0.0':
+                #Default for ASDC
+                self.baseurl = self.settings["default_baseurl"]
+            else:
+                #For localhost
+                baseurl = nbconfig['url']
+                if baseurl[-1] == '/':
+                    baseurl = baseurl[0:-1] #Remove trailing /
+                self.baseurl = baseurl
+        logging.info("Base url: %s", self.baseurl)
+
+    def _serve(self, background=False):
+        """
+        Listen for the token passed by browser on client side
+        (Tried using websockets here, but wss: connections are not handled by jupyter-server-proxy)
+
+        If background is set the server runs in its own thread so the token can be received
+        while the notebook is busy running other cells
+
+        See: https://notebook.community/knowledgeanyhow/notebooks/hacks/Webserver%20in%20a%20Notebook
+        """
+        import tornado.ioloop
+        import tornado.web
+        import tornado.httpserver
+        client = self
+
+        def set_token(data, verify=True):
+            logging.debug("Verfifying, nonce: %s, verify enabled: %s", client.nonce, verify)
+            if verify and data['id_token']['nonce'] != client.nonce:
+                logging.error("INVALID TOKEN! Nonce does not match")
+                client._set_token(None)
+            else:
+                if verify:
+                    logging.debug("==> TOKEN VALIDATED!")
+                else:
+                    logging.debug("==> TOKEN Reused, already validated")
+                expires_at = None
+                if not verify:
+                    #Saved by the browser from an earlier login, expires_in counts from then
+                    #so use the absolute expiry times instead
+                    times = [data.get('expires_at'), (data.get('id_token') or {}).get('exp')]
+                    times = [int(t) for t in times if t]
+                    expires_at = min(times) if times else time.time()
+                client._set_token(data, expires_at)
+                if client._server_loop is not None and not client._batches:
+                    #Finished with the background server, stop once this response is sent
+                    client._server_loop.call_later(0.5, client._stop_background)
+
+        class MainHandler(tornado.web.RequestHandler):
+            def get(self):
+                #'''Renders the template with a title on HTTP GET.'''
+                #self.finish(page.render(title='Tornado Demo'))
+                #Just confirm server is running
+                self.finish('OK')
+
+        class TokenHandler(tornado.web.RequestHandler):
+            def post(self):
+                data = self.request.body
+                t = json.loads(data)
+                logging.debug("==> TOKEN RECEIVED via POST")
+                set_token(t)
+                self.finish("Token processed")
+
+            def get(self):
+                import base64
+                logging.debug("==> TOKEN RECEIVED via GET")
+                data = self.get_argument("data", default=None, strip=False)
+                verify = self.get_argument("verify", default="True", strip=False)
+                t = json.loads(base64.b64decode(data).decode('utf-8'))
+                set_token(t, verify == "True") #Can't verify when reusing token as nonce may have been cleared
+                self.finish("Token processed")
+
+        class ResultsHandler(tornado.web.RequestHandler):
+            #Results of requests made by the browser for call_api_js_batch()
+            def post(self):
+                t = json.loads(self.request.body)
+                batch = client._batches.get(t["id"])
+                if batch is None:
+                    raise tornado.web.HTTPError(404)
+                batch._add(t["results"])
+                self.finish("Results processed")
+
+            def get(self):
+                #Fallback if POST not allowed, results sent in pieces of base64 encoded json
+                batch = client._batches.get(self.get_argument("id"))
+                if batch is None:
+                    raise tornado.web.HTTPError(404)
+                batch._add_piece(self.get_argument("part"), int(self.get_argument("seq")),
+                                 int(self.get_argument("total")), self.get_argument("data", strip=False))
+                self.finish("Results processed")
+
+        application = tornado.web.Application([
+            (r"/", MainHandler),
+            (r"/token", TokenHandler),
+            (r"/results", ResultsHandler)
+        ])
+
+        def listen():
+            #Selects a random port by default,
+            #allowing multiple notebooks to use this without conflicts
+            self._server = tornado.httpserver.HTTPServer(application)
+            self._server.listen(self.port, '0.0.0.0')
+
+            #Get the actual port assigned
+            if self.port is None:
+                #(First entry in _sockets)
+                socket = self._server._sockets[next(iter(self._server._sockets))]
+                self.port = socket.getsockname()[1]
+
+            logging.debug("Running on port: %s", self.port)
+
+        if not background:
+            listen()
+            return
+
+        import asyncio
+        ready = threading.Event()
+        errors = []
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            async def start():
+                listen()
+            try:
+                loop.run_until_complete(start())
+                self._server_loop = loop
+            except Exception as e:
+                errors.append(e)
+            ready.set()
+            if not errors:
+                loop.run_forever()
+            loop.close()
+
+        threading.Thread(target=run, name="jupyter_oauth2_listener", daemon=True).start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+
+    def _start_listener(self, background=False):
+        """Start the token listener server unless already running"""
+        with self._lock:
+            if background and self._server is not None and self._server_loop is None:
+                #Left running on the notebook's event loop by connect() timing out, it can't
+                #respond while a cell is blocked waiting for it, so restart in the background
+                self._server.stop()
+                self._server = None
+                self.port = None
+            if self._server is None:
+                self._serve(background)
+
+    def _stop_background(self, force=False):
+        """Stop the server running in the background thread, call from that thread
+
+        Parameters
+        ----------
+        force: boolean
+            stop even if a browser batch or login started since this was scheduled is still using the server
+        """
+        with self._lock:
+            if not force:
+                pending = self._pending
+                if self._batches or (pending is not None and not pending.done()):
+                    return
+            loop = self._server_loop
+            if self._server is not None:
+                self._server.stop()
+            self._server = None
+            self._server_loop = None
+            self.port = None
+        loop.stop()
+
+    def _listener(self):
+        """ Setup the listener to receive reponse message posted from popup or iframe
+        that processes the oauth2 request
+        """
+        if not self.baseurl: self.get_url()
+        #New nonce for each login, the listener only accepts the response with this nonce
+        import secrets
+        self.nonce = secrets.token_urlsafe(nbytes=8)
+        from IPython.display import display, HTML
+        from string import Template
+        temp_obj = Template("""
+        <script>
+        //Have the token, send back to server with HTTP POST
+        function postToken_$PORT(data) {
+            var xhr = new XMLHttpRequest();
+            xhr.open("POST", '$BASEURL/proxy/$PORT/token', true);
+            //Send the proper header information along with the request
+            xhr.setRequestHeader("Content-Type", "application/json");
+            xhr.onload = function() {console.log('postToken successful');}
+            xhr.send(JSON.stringify(data));
+        }
+
+        //Have the token, send back to server with HTTP GET
+        function postTokenGET_$PORT(data, reuse) {
+            var xhr = new XMLHttpRequest();
+            var encoded = window.btoa(JSON.stringify(data));
+            var uri = '$BASEURL/proxy/$PORT/token?data=' + encoded;
+            if (reuse)
+                uri += '&verify=False';
+            xhr.open("GET", uri);
+            xhr.onload = function() {console.log('postTokenGET successful');}
+            xhr.send();
+        }
+
+        //Get message from iframe or popup
+        function message_received_$PORT(event) {
+            //console.log("ORIGIN:" + event.origin);
+            //console.log("MESSAGE:" + JSON.stringify(event.data));
+            var data = event.data;
+            if (data && typeof data == "object" && "access_token" in data) {
+                //Other clients may be logging in at the same time, only take the response to this login
+                var nonce = data.id_token ? data.id_token.nonce : '';
+                if (data.state != "auth0,$NONCE" && nonce != "$NONCE") return;
+                //Save token on client side, for this client id and audience only
+                window.tokens = window.tokens || {};
+                window.tokens[$KEY] = data;
+                //Absolute expiry for when the saved token is re-used
+                if (data.expires_in) data.expires_at = Math.floor(Date.now() / 1000) + Number(data.expires_in);
+
+                //POST gets 405 method not allowed on jupyterhub
+                //postToken_$PORT(event.data);
+                postTokenGET_$PORT(event.data);
+
+                //Stop listening after sending token
+                window.removeEventListener('message', message_received_$PORT);
+                //window.listenerExists = false;
+            }
+        }
+        window.addEventListener("message", message_received_$PORT);
+        </script>
+        """)
+        script = temp_obj.substitute(BASEURL=self.baseurl, PORT=str(self.port), NONCE=self.nonce, KEY=self._browser_key())
+        display(HTML(script))
+
+    def _browser_key(self):
+        #Tokens saved in the browser are kept separately for each client id and audience (as a js string)
+        return json.dumps(self.settings["api_client_id"] + " " + self.settings["api_audience"])
+
+    def _send(self, mode='popup', scope=""):
+        """ Open auth request page with iframe / popup / link and listen for postMessage
+
+        Parameters
+        ----------
+        mode : str
+            'popup' opens page in new window/tab (may require disabling popup blockers)
+            'iframe' opens page in inline iframe (this seems less reliable)
+            'link' displays link to the auth page without opening it automatically
+        scope : str
+            Any additional scopes to append to the configured list
+        """
+        import urllib.parse
+        #This uses jupyter-server-proxy entry-point magic to provide a consistent callback url
+        #(package jupyter_oauth2 must be installed: pip install git+https://github.com/AuScalableDroneCloud/jupyter_oauth2.git)
+        redirect = self.baseurl + '/jupyter_oauth2/callback'
+        #(nonce created by _listener())
+        nonce = self.nonce
+        f = {'response_type' : 'token id_token',
+             'redirect_uri' : redirect,
+             'client_id' : self.settings["api_client_id"],
+             'audience' : self.settings["api_audience"],
+             'scope' : self._scope(scope),
+             'nonce' : nonce,
+             'state' : 'auth0,' + nonce,
+             #'state' : 'auth0,iframe,' + nonce,
+             #'state' : 'auth0,popup,' + nonce,
+             #'prompt' : 'none'}
+            }
+        logging.debug("Auth query params: %s", f)
+        #print("Auth query params: ", f)
+        query = urllib.parse.urlencode(f)
+        authurl = self.endpoint('authorization_endpoint') + '?' + query
+
+        from IPython.display import display, HTML
+        from string import Template
+        temp_obj = Template("""<script>
+        //This code only has 10 seconds to run after the output produced
+        //(Prevents re-running from saved notebook output)
+        var now = new Date().getTime();
+        var ts = new Date(document.getElementById('$ID').dataset.timestamp * 1000);
+        if (now - ts < 10000) {
+            var mode = "$MODE";
+            var now = new Date().valueOf();
+            var saved = (window.tokens || {})[$KEY];
+            if (saved) console.log("Token expired?: " + saved['id_token']['exp']*1000 + ' > ' + now);
+            if (saved && saved['id_token']['exp']*1000 > now && !(saved['expires_at']*1000 <= now)) {
+                //Use token saved on client side by a previous login of this client
+                postTokenGET_$PORT(saved, true); //Pass re-use flag to skip verification
+            } else {
+                var html = '';
+                if (mode == 'popup') {
+                    window.open("$URL");
+                    html += '(Authentication window may not appear if you have a popup blocker, <a href="$URL" target="_blank" rel="opener">Click here to login</a> instead)';
+                } else if (mode == 'iframe') {
+                    html = '<iframe src="$URL" width="0px" height="0px">';
+                } else if (mode == 'iframe_debug') {
+                    html = '<iframe src="$URL" width="400px" height="300px" style="border:1px solid #ccc;">';
+                } else if (mode == 'link') {
+                    html += '<h3><a href="$URL" target="_blank" rel="opener">Click here to login</a></h3>';
+                }
+                document.getElementById('$ID').innerHTML = html;
+            }
+        } else {
+          console.log("Fragment expired, skipping run: " + new Date(now).toUTCString() + " : " + new Date(ts).toUTCString());
+        }
+        </script>
+        <div id="$ID" data-timestamp="$NOW"></div>
+        """)
+        script = temp_obj.substitute(URL=authurl, ID="auth_" + nonce, MODE=mode, PORT=self.port, NOW=str(int(time.time())),
+                                     KEY=self._browser_key())
+        display(HTML(script))
+
+    async def connect(self, config=None, mode='popup', timeout_seconds=30, scope=""):
+        """
+        Authenticate with the OAuth2 id provider
+
+        See the module level connect() for details, parameters are the same
+        """
+        if config is not None:
+            self.setup(config)
+        self._check_settings()
+        if self._machine():
+            #No browser or listener needed
+            self.client_connect(scope=scope)
+            return
+
+        #Have a token already? Renew if expired
+        if self.token_expired():
+            self._set_token(None)
+
+        #Setup the server, listener and send the auth request
+        if not self.token_data:
+            self._start_listener()
+            self._listener()
+            self._send(mode, scope)
+
+            import asyncio
+            print('Waiting for authorisation', end='')
+            for i in range(0,timeout_seconds*4): #4 ticks per second
+                #Have the token yet?
+                if self.token_data: break
+                #Async sleep to allow server to process requests
+                await asyncio.sleep(0.25)
+                #Blocking sleep to actually pause processing
+                time.sleep(0.25)
+                #Visual feedback
+                print('.', end='')
+                sys.stdout.flush()
+
+            if not self.token_data:
+                raise(Exception("Timed out awaiting access token! "))
+            else:
+                print('.. success.')
+
+            await self.stop_server()
+        else:
+            print('Already have a valid token')
+
+    def connect_nowait(self, config=None, mode='popup', timeout_seconds=300, scope=""):
+        """
+        Start authenticating with the OAuth2 id provider without waiting for the login to complete
+
+        See the module level connect_nowait() for details, parameters are the same
+
+        Returns
+        -------
+        LoginHandle
+            handle to wait on the login
+        """
+        if config is not None:
+            self.setup(config)
+        self._check_settings()
+        if self._machine():
+            #No user interaction, just get the token now
+            self.client_connect(scope=scope)
+            return LoginHandle(self, timeout_seconds)
+
+        #Have a token already? Renew if expired
+        if self.token_expired():
+            self._set_token(None)
+
+        pending = self._pending
+        if pending is not None and (time.time() >= pending.deadline or pending.settings != self.settings):
+            #Timed out or settings changed, start a new login instead
+            self._pending = None
+        if self._pending is not None:
+            #Already waiting on a login
+            return self._pending
+        if not self.token_data:
+            self._start_listener(background=True)
+            self._listener()
+            self._send(mode, scope)
+            self._pending = LoginHandle(self, timeout_seconds)
+            return self._pending
+        return LoginHandle(self, timeout_seconds)
+
+    def _await_login(self):
+        """Wait for a login started by connect_nowait() before an API call that needs it"""
+        pending = self._pending
+        if pending is not None:
+            pending.wait()
+
+    async def stop_server(self):
+        """Stop the server
+        Called automatically upon recieving token except in case of timeout
+        """
+        if self._server_loop is not None:
+            self._server_loop.call_soon_threadsafe(self._stop_background, True)
+            return
+        if self._server is None:
+            return
+        await self._server.close_all_connections()
+        self._server.stop()
+        self._server = None
+        self.port = None
+
+    def device_connect(self, config=None, qrcode=True, scope=""):
+        """
+        Authenticate with the OAuth2 id provider using the device auth flow
+
+        See the module level device_connect() for details, parameters are the same
+        """
+        if config is not None:
+            self.setup(config)
+        self._check_settings()
+        if self._machine():
+            #No user interaction needed
+            self.client_connect(scope=scope)
+            return
+        settings = self.settings
+
+        if qrcode:
+            #Disable qrcode if module not installed
+            try:
+                import io
+                import qrcode
+                from PIL import Image
+            except (ImportError) as e:
+                qrcode = False
+                pass
+
+        headers = {
+            "content-type": "application/x-www-form-urlencoded",
+        }
+        data = {
+            "client_id": settings['api_client_id'],
+            "scope": self._scope(scope),
+            "audience": settings['api_audience']
+        }
+
+        response = self.session.post(self.endpoint('device_authorization_endpoint'), headers=headers, data=data)
+        if response.status_code >= 500 or "error" in response.json():
+            print(response.json())
+            raise(Exception("Error response from device code request!"))
+
+        logging.info(response.json())
+        user_code = response.json()["user_code"]
+        verify_url = response.json().get("verification_uri_complete", response.json().get("verification_uri"))
+        device_code = response.json()["device_code"]
+        if is_notebook():
+            from IPython.display import display, HTML
+
+            display(f"Click link below to authenticate (verify code={user_code})")
+            display(HTML(f'<h1>{user_code}</h1><a href="{verify_url}" target="_blank">{verify_url}</a>'))
+            if qrcode:
+                qr = qrcode.make(verify_url, box_size=5)
+                display(qr)
+        else:
+            print(f"Click or copy link below to authenticate (verify code={user_code})")
+            print(" _______________ ")
+            print("|               |")
+            print('|   \033[1m' + user_code + '\033[0m   |')
+            print("|_______________|\n")
+            print(verify_url)
+            if qrcode:
+                qr = qrcode.QRCode()
+                qr.add_data(verify_url)
+                qr.print_ascii()
+
+        headers2 = {
+            "content-type": "application/x-www-form-urlencoded",
+        }
+        data2 = {
+            "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
+            "device_code": device_code,
+            "client_id": settings['api_client_id'],
+        }
+
+        logged_in = False
+        token = {}
+        while not logged_in:
+            time.sleep(2)
+            token = self.session.post(self.endpoint('token_endpoint'), headers=headers2, data=data2)
+            if token.status_code == 200:
+                if is_notebook():
+                    from IPython.display import display
+
+                    display(f"Successfully authenticated!")
+                else:
+                    print("Successfully authenticated!")
+                    logged_in = True
+            token_json = token.json()
+            if "access_token" in token_json:
+                self._set_token(token_json)
+                break
+
+    def set_json_codec(self, dumps=None, loads=None):
+        """
+        Set the functions used to encode request and decode response json
+
+        Parameters
+        ----------
+        dumps: function
+            object to json str or bytes, default is the json module (pass orjson.dumps for speed)
+        loads: function
+            json str or bytes to object, default is the json module (pass orjson.loads for speed)
+        """
+        default_dumps, default_loads = _json_codec()
+        self.json_dumps = dumps or default_dumps
+        self.json_loads = loads or default_loads
+
+    def reset_metrics(self):
+        """Reset the transfer metrics"""
+        with self._metrics_lock:
+            self.metrics = {
+                "requests": 0,
+                "request_bytes": 0,          #Request bodies sent (after compression)
+                "request_bytes_saved": 0,    #Reduction from request compression
+                "response_bytes": 0,         #Response bodies received over the wire
+                "response_bytes_saved": 0,   #Reduction from response compression
+                "decoded": 0,                #Responses decoded with decode_json()
+                "decode_seconds": 0.0,
+            }
+
+    def _count(self, **values):
+        with self._metrics_lock:
+            for k, v in values.items():
+                self.metrics[k] += v
+
+    def _encode_body(self, data, headers):
+        """Encode json request body, compressing large bodies if enabled"""
+        body = self.json_dumps(data)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        saved = 0
+        if self.settings["compress_requests"] and len(body) >= self.settings["compress_min_bytes"]:
+            import gzip
+            size = len(body)
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+            saved = size - len(body)
+        self._count(request_bytes=len(body), request_bytes_saved=saved)
+        return body
+
+    def _record(self, r):
+        """Record transfer sizes of a completed response"""
+        size = len(r.content)
+        try:
+            #Bytes actually read over the wire, before decompression
+            if hasattr(r, 'num_bytes_downloaded'):
+                wire = r.num_bytes_downloaded #httpx
+            else:
+                wire = r.raw.tell()
+        except Exception:
+            wire = size
+        self._count(requests=1, response_bytes=wire, response_bytes_saved=max(0, size - wire))
+
+    def decode_json(self, r):
+        """
+        Decode a json response with the configured codec (see set_json_codec())
+
+        Parameters
+        ----------
+        r: object
+            http response object from call_api()
+
+        Returns
+        -------
+        object
+            decoded json data
+        """
+        start = time.perf_counter()
+        data = self.json_loads(r.content)
+        self._count(decoded=1, decode_seconds=time.perf_counter() - start)
+        return data
+
+    def _headers(self, prefix=None):
+        """Headers for an API call with the current token"""
+        if prefix is None:
+            prefix = self.settings["token_prefix"]
+        access_token = self.access_token
+        #WebODM api call
+        return {
+        'accept': 'application/json',
+        'Content-type': 'application/json',
+        'Authorization': prefix + ' ' + access_token if access_token else '',
+        }
+
+    def call_api(self, url, data=None, throw=False, prefix=None):
+        """
+        Call an API endpoint
+
+        See the module level call_api() for details, parameters are the same
+        """
+        if self._machine():
+            self._ensure_token()
+        elif self._pending is not None:
+            self._await_login()
+        method, url, headersAPI, body = self._prepare(url, data, prefix)
+
+        if self._middleware:
+            r = self._chain(ApiRequest(method, url, headersAPI, body, data))
+        else:
+            r = self._transport_send(method, url, headersAPI, body)
+        return self._check(r, throw)
+
+    def _transport_send(self, method, url, headers, body):
+        """Send a request with the selected transport"""
+        if self._http2():
+            r = self.http2_client.request(method, url, headers=headers, content=body)
+        else:
+            r = self.session.request(method, url, headers=headers, data=body)
+        self._record(r)
+        return r
+
+    async def _send_async(self, method, url, headers, body):
+        """Send a request without blocking the event loop"""
+        if self._http2():
+            #Concurrent calls are multiplexed as streams over one HTTP/2 connection
+            r = await self._http2_async_client().request(method, url, headers=headers, content=body)
+            self._record(r)
+            return r
+        #Run in a thread with the requests session
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._transport_send, method, url, headers, body)
+
+    def _send_request(self, request):
+        #Last step of the middleware chain
+        return self._transport_send(request.method, request.url, request.headers, request.body)
+
+    async def _send_request_async(self, request):
+        return await self._send_async(request.method, request.url, request.headers, request.body)
+
+    def add_middleware(self, middleware, index=None):
+        """
+        Add a layer to the request/response middleware chain
+
+        See the module level add_middleware() for details, parameters are the same
+        """
+        with self._lock:
+            layers = list(self._middleware)
+            layers.insert(len(layers) if index is None else index, middleware)
+            self._set_middleware(layers)
+
+    def remove_middleware(self, middleware):
+        """
+        Remove a layer from the middleware chain
+
+        Parameters
+        ----------
+        middleware: object
+            middleware previously passed to add_middleware()
+        """
+        with self._lock:
+            self._set_middleware([m for m in self._middleware if m is not middleware])
+
+    def _set_middleware(self, layers):
+        """Compose the chain once here rather than on every call"""
+        chain = self._send_request
+        chain_async = self._send_request_async
+        for m in reversed(layers):
+            chain = functools.partial(_call_middleware, m, chain)
+            chain_async = functools.partial(_call_middleware_async, m, chain_async)
+        self._chain, self._chain_async = chain, chain_async
+        self._middleware = layers
+
+    def _prepare(self, url, data, prefix):
+        """Method, full url, headers and encoded body for an API call"""
+        if url[0:4] != "http":
+            #Prepend the configured api url
+            url = self.settings["api_audience"] + url
+
+        headersAPI = self._headers(prefix)
+
+        #POST if data provided, otherwise GET
+        if data:
+            return "POST", url, headersAPI, self._encode_body(data, headersAPI)
+        return "GET", url, headersAPI, None
+
+    def _check(self, r, throw):
+        """Report error responses"""
+        #Note: if response is 403 Forbidden {'detail': 'Username not available'}
+        # this is because the user hasn't logged in to the main site yet with this auth method
+        # (ie: originally logged in with github, use AAF to auth with jupyter)
+        if r.status_code >= 400:
+            print(r.status_code, getattr(r, 'reason', None) or getattr(r, 'reason_phrase', ''))
+            if throw:
+                raise(Exception("Error response from server!"))
+        #print(r.text)
+        return r
+
+    def call_api_json(self, url, data=None, throw=False, prefix=None):
+        """
+        Call an API endpoint and decode the json response
+
+        See the module level call_api_json() for details, parameters are the same
+        """
+        return self.decode_json(self.call_api(url, data, throw, prefix))
+
+    def iter_api_items(self, url, path='item', data=None, prefix=None, chunk_size=65536):
+        """
+        Call an API endpoint and iterate over the items of a json array in the response as it is received
+
+        See the module level iter_api_items() for details, parameters are the same
+        """
+        if self._machine():
+            self._ensure_token()
+        elif self._pending is not None:
+            self._await_login()
+        method, url, headersAPI, body = self._prepare(url, data, prefix)
+
+        size = 0
+        def counted(chunks):
+            nonlocal size
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+
+        if self._http2():
+            with self.http2_client.stream(method, url, headers=headersAPI, content=body) as r:
+                self._check(r, True)
+                yield from jupyter_oauth2_stream.iter_items(counted(r.iter_bytes(chunk_size)), path, self.json_loads)
+                wire = r.num_bytes_downloaded
+        else:
+            with self.session.request(method, url, headers=headersAPI, data=body, stream=True) as r:
+                self._check(r, True)
+                yield from jupyter_oauth2_stream.iter_items(counted(r.iter_content(chunk_size)), path, self.json_loads)
+                wire = r.raw.tell()
+        self._count(requests=1, response_bytes=wire, response_bytes_saved=max(0, size - wire))
+
+    async def call_api_async(self, url, data=None, throw=False, prefix=None):
+        """
+        Call an API endpoint without blocking the event loop
+
+        See the module level call_api_async() for details, parameters are the same
+        """
+        if self._pending is not None:
+            await self._pending
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if not self._middleware and not self._http2():
+            #Run the whole call in a thread with the requests session
+            return await loop.run_in_executor(None, functools.partial(self.call_api, url, data, throw, prefix))
+
+        if self._machine():
+            await loop.run_in_executor(None, self._ensure_token)
+        method, url, headersAPI, body = self._prepare(url, data, prefix)
+        if self._middleware:
+            r = await self._chain_async(ApiRequest(method, url, headersAPI, body, data))
+        else:
+            r = await self._send_async(method, url, headersAPI, body)
+        return self._check(r, throw)
+
+    def call_api_js(self, url, callback="alert()", data=None, prefix=None):
+        """
+        Call an API endpoint from the browser via Javascript, appends a script to the page to
+        do the request.
+
+        See the module level call_api_js() for details, parameters are the same
+        """
+        if prefix is None:
+            prefix = self.settings["token_prefix"]
+        #GET, list nodes, passing url and token from python
+        from IPython.display import display, HTML
+        #Generate a code to prevent this call happening again if page reloaded without clearing
+        import string
+        import secrets
+        alphabet = string.ascii_letters + string.digits
+        code = "req_" + ''.join(secrets.choice(alphabet) for i in range(8))
+        method = "POST"
+        if data is None:
+            method = "GET"
+            data = {}
+        from string import Template
+        temp_obj = Template("""<script>
+        //Prevent multiple calls
+        if (!window._requests)
+          window._requests = {};
+        if (!window._requests["$CODE"]) {
+            var data = $DATA;
+            var callback = $CALLBACK;
+            var xhr = new XMLHttpRequest();
+            xhr.open("$METHOD", "$URL");
+            xhr.setRequestHeader("Authorization", "$PREFIX $TOKEN");
+            //Can also just grab it from window...
+            //xhr.setRequestHeader("Authorization", "$PREFIX " + window.token['access_token']);
+            xhr.responseType = 'json';
+            xhr.onload = function() {
+                // Request finished. Do processing here.
+                var data = xhr.response;
+                console.log('success');
+                callback(xhr.response);
+            }
+
+            if (data && Object.keys(data).length) {
+                var formData = new FormData();
+                for (var key in data)
+                    formData.append(key, data[key]);
+
+                xhr.send(formData);
+            } else {
+                xhr.send();
+            }
+
+            //Flag request sent
+            window._requests["$CODE"] = true;
+        }
+        </script>
+        """)
+        script = temp_obj.substitute(DATA=json.dumps(data),
+                    CODE=code, METHOD=method, URL=url,
+                    TOKEN=self.access_token, PREFIX=prefix, CALLBACK=callback)
+        display(HTML(script))
+
+    def call_api_js_batch(self, calls, concurrency=6, timeout_seconds=60, prefix=None):
+        """
+        Call a list of API endpoints from the browser and get the results back in python
+
+        See the module level call_api_js_batch() for details, parameters are the same
+
+        Returns
+        -------
+        BrowserBatch
+            handle to get the results
+        """
+        if self._pending is not None:
+            #The browser needs the token from the login started by connect_nowait()
+            self._await_login()
+        if prefix is None:
+            prefix = self.settings["token_prefix"]
+        if not self.baseurl: self.get_url()
+        reqs = []
+        for c in calls:
+            if isinstance(c, str):
+                c = {"url": c}
+            elif not isinstance(c, dict):
+                c = dict(zip(("url", "data"), c))
+            url = c["url"]
+            if url[0:4] != "http":
+                #Prepend the configured api url
+                url = self.settings["api_audience"] + url
+            data = c.get("data")
+            reqs.append({"url": url, "method": "POST" if data else "GET", "data": data if data else None})
+
+        import secrets
+        code = "batch_" + secrets.token_urlsafe(nbytes=12)
+        batch = BrowserBatch(self, code, len(reqs), timeout_seconds)
+        with self._lock:
+            self._batches[code] = batch
+            #Results are received by the token listener server
+            self._start_listener(background=True)
+        if not reqs:
+            batch._add([])
+            return batch
+
+        from IPython.display import display, HTML
+        from string import Template
+        temp_obj = Template("""<script>
+        //Prevent multiple calls, and only run within 10 seconds of output being produced
+        //(Prevents re-running from saved notebook output)
+        if (!window._requests)
+          window._requests = {};
+        var ts = new Date(document.getElementById('$CODE').dataset.timestamp * 1000);
+        if (!window._requests["$CODE"] && new Date().getTime() - ts < 10000) {
+            window._requests["$CODE"] = true;
+            (async function() {
+                const reqs = $REQUESTS;
+                const endpoint = '$BASEURL/proxy/$PORT/results';
+                //Jupyter server requires the xsrf token to POST through the proxy
+                var xsrf = '';
+                document.cookie.split(';').forEach(function(c) {
+                    c = c.trim();
+                    if (c.indexOf('_xsrf=') == 0) xsrf = decodeURIComponent(c.substring(6));
+                });
+                var parts = 0;
+                async function deliver(items) {
+                    const body = JSON.stringify({id: "$CODE", results: items});
+                    try {
+                        const r = await fetch(endpoint, {method: 'POST', body: body,
+                            headers: {'Content-Type': 'application/json', 'X-XSRFToken': xsrf}});
+                        if (r.ok) return;
+                    } catch (e) {}
+                    //POST failed, send with GET in pieces
+                    const encoded = window.btoa(unescape(encodeURIComponent(JSON.stringify(items))));
+                    const size = 4000;
+                    const total = Math.ceil(encoded.length / size);
+                    const part = String(parts++);
+                    for (var seq = 0; seq < total; seq++) {
+                        const q = new URLSearchParams({id: "$CODE", part: part, seq: seq, total: total,
+                                                       data: encoded.substring(seq * size, (seq + 1) * size)});
+                        await fetch(endpoint + '?' + q.toString());
+                    }
+                }
+                //Results are passed back in groups as they complete
+                var buffer = [];
+                var sending = [];
+                function flush() {
+                    if (buffer.length) {
+                        sending.push(deliver(buffer));
+                        buffer = [];
+                    }
+                }
+                const timer = setInterval(flush, $FLUSH_MS);
+                var next = 0;
+                async function worker() {
+                    while (next < reqs.length) {
+                        const i = next++;
+                        const q = reqs[i];
+                        var item = {index: i};
+                        try {
+                            var opts = {method: q.method, headers: {'Authorization': "$PREFIX $TOKEN", 'Accept': 'application/json'}};
+                            if (q.data) {
+                                opts.headers['Content-Type'] = 'application/json';
+                                opts.body = JSON.stringify(q.data);
+                            }
+                            const r = await fetch(q.url, opts);
+                            item.status = r.status;
+                            const text = await r.text();
+                            try {
+                                item.data = JSON.parse(text);
+                            } catch (e) {
+                                item.text = text;
+                            }
+                        } catch (e) {
+                            item.status = 0;
+                            item.error = String(e);
+                        }
+                        buffer.push(item);
+                    }
+                }
+                var workers = [];
+                for (var w = 0; w < Math.min($CONCURRENCY, reqs.length); w++)
+                    workers.push(worker());
+                await Promise.all(workers);
+                clearInterval(timer);
+                flush();
+                await Promise.all(sending);
+                console.log('$CODE complete');
+            })();
+        }
+        </script>
+        <div id="$CODE" data-timestamp="$NOW"></div>
+        """)
+        script = temp_obj.substitute(CODE=code, REQUESTS=json.dumps(reqs), BASEURL=self.baseurl,
+                    PORT=str(self.port), PREFIX=prefix, TOKEN=self.access_token,
+                    CONCURRENCY=int(concurrency), FLUSH_MS=100, NOW=str(int(time.time())))
+        display(HTML(script))
+        return batch
+
+    def _batch_done(self, batch):
+        """Remove a finished batch, stopping the background server if nothing else needs it"""
+        with self._lock:
+            self._batches.pop(batch.code, None)
+            if not self._batches and self._pending is None and self._server_loop is not None:
+                self._server_loop.call_soon_threadsafe(self._stop_background)
+
+    def userinfo(self):
+        """
+        Call the userinfo API from Auth0 to get user details
+
+        Returns
+        -------
+        dict
+            json dict containing user info
+        """
+        r = self.call_api(self.endpoint('userinfo_endpoint')) #, prefix='Bearer')
+        data = r.json()
+        return data
+
+    def showuserinfo(self):
+        """
+        Call the userinfo API from Auth0 and display username/email and avatar image inline
+        """
+        user = self.userinfo()
+        #print(json.dumps(user, indent=4, sort_keys=True))
+        print("Username: ", user["name"])
+        from IPython.display import display, HTML
+        display(HTML("<img src='" + user["picture"] + "' width='120' height='120'>"))
+
+#Default client used by the module level functions below
+_client = AuthClient()
+
+#Module level state is read from the default client
+#(settings, access_token, token_data, nonce, port, baseurl were previously globals here)
+_client_attrs = ['settings', 'baseurl', 'access_token', 'token_data', 'expires_at', 'port', 'nonce', '_server']
+
+def __getattr__(name):
+    if name in _client_attrs:
+        return getattr(_client, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class _Module(types.ModuleType):
+    #Assigning the old globals, eg: auth.access_token = token, sets them on the default client
+    def __setattr__(self, name, value):
+        if name in _client_attrs:
+            setattr(_client, name, value)
+        else:
+            super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Module
+
+def default_client():
+    """
+    Get the default client used by the module level functions
+
+    Returns
+    -------
+    AuthClient
+        the shared default client
+    """
+    return _client
+
+#Auth0 style endpoint paths on "api_authurl", used if not found by discovery
+_default_endpoints = {
+    "authorization_endpoint": '/authorize',
+    "token_endpoint": '/oauth/token',
+    "device_authorization_endpoint": '/oauth/device/code',
+    "userinfo_endpoint": '/userinfo',
+    "jwks_uri": '/.well-known/jwks.json',
+}
+
+#Provider configurations shared by all clients in the process
+#{discovery url : {"metadata": dict, "expires": timestamp, "etag": str, "last_modified": str}}
+_discovery = {}
+_discovery_lock = threading.Lock()
+
+def _cache_expiry(headers, default_ttl):
+    """
+    Work out when a response expires from its HTTP caching headers
+
+    Returns
+    -------
+    tuple
+        (expiry timestamp, True if the response may be stored)
+    """
+    import email.utils
+    now = time.time()
+    cc = {}
+    for d in headers.get("Cache-Control", "").split(','):
+        k, _, v = d.strip().partition('=')
+        if k:
+            cc[k.lower()] = v.strip('"')
+    if 'no-store' in cc:
+        return now, False
+    if 'no-cache' in cc:
+        return now, True
+    if 'max-age' in cc:
+        try:
+            age = int(headers.get("Age", 0))
+            return now + max(0, int(cc['max-age']) - age), True
+        except ValueError:
+            pass
+    if "Expires" in headers:
+        try:
+            expires = email.utils.parsedate_to_datetime(headers["Expires"]).timestamp()
+            if "Date" in headers:
+                #Relative to the server clock
+                expires = now + expires - email.utils.parsedate_to_datetime(headers["Date"]).timestamp()
+            return expires, True
+        except (TypeError, ValueError):
+            #Invalid dates mean already expired
+            return now, True
+    return now + default_ttl, True
+
+class ApiRequest:
+    """
+    API call passed through the middleware chain, layers may modify any of the attributes
+
+    Parameters
+    ----------
+    method: str
+        'GET' or 'POST'
+    url: str
+        full url
+    headers: dict
+        request headers, including Authorization
+    body: bytes
+        encoded request body or None
+    data: object
+        the json data passed to call_api, or None
+    """
+    __slots__ = ('method', 'url', 'headers', 'body', 'data', 'context')
+
+    def __init__(self, method, url, headers, body=None, data=None):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.data = data
+        self.context = {} #For layers to pass information along the chain
+
+    def __repr__(self):
+        return "<ApiRequest {} {}>".format(self.method, self.url)
+
+class Middleware:
+    """
+    Base class for call_api middleware layers, used by both the sync and async calls
+
+    Override process_request() / process_response() to modify requests and responses,
+    or override __call__() and call_async() to control the call itself (eg: retries, caching)
+    where call_next(request) sends the request on to the next layer and returns the response.
+    """
+    def process_request(self, request):
+        """Called with the ApiRequest before it is sent"""
+        pass
+
+    def process_response(self, request, response):
+        """Called with the response, returns the response to pass back"""
+        return response
+
+    def __call__(self, request, call_next):
+        self.process_request(request)
+        return self.process_response(request, call_next(request))
+
+    async def call_async(self, request, call_next):
+        self.process_request(request)
+        return self.process_response(request, await call_next(request))
+
+class RetryMiddleware(Middleware):
+    """
+    Retry API calls on connection errors and temporary server errors with exponential backoff
+
+    Only GET and HEAD calls are retried by default, the server may have already processed a POST
+    that failed, so POSTs are only retried if the server responds 429 or 503 with Retry-After.
+
+    Parameters
+    ----------
+    retries: int
+        maximum number of retries
+    backoff: float
+        seconds to wait before the first retry, doubled for each following retry
+        (Retry-After is used instead if the server sends it)
+    statuses: tuple
+        http status codes to retry
+    methods: tuple
+        http methods safe to repeat, add 'POST' if your API calls can be repeated without side effects
+    """
+    def __init__(self, retries=3, backoff=0.5, statuses=(429, 502, 503, 504), methods=('GET', 'HEAD')):
+        self.retries = retries
+        self.backoff = backoff
+        self.statuses = statuses
+        self.methods = methods
+        self.errors = (requests.ConnectionError, requests.Timeout)
+        try:
+            import httpx
+            self.errors += (httpx.TransportError,)
+        except ImportError:
+            pass
+
+    def _delay(self, attempt, response):
+        if response is not None:
+            try:
+                return float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                pass
+        return self.backoff * 2 ** attempt
+
+    def _retry(self, request, response):
+        """Check if a failed attempt can be repeated"""
+        if request.method in self.methods:
+            return response is None or response.status_code in self.statuses
+        #Other requests only if the server says it did not process it and to come back later
+        return (response is not None and response.status_code in (429, 503)
+                and response.status_code in self.statuses and "Retry-After" in response.headers)
+
+    def __call__(self, request, call_next):
+        for attempt in range(self.retries + 1):
+            r = None
+            try:
+                r = call_next(request)
+                if attempt == self.retries or not self._retry(request, r):
+                    return r
+            except self.errors:
+                if attempt == self.retries or not self._retry(request, None):
+                    raise
+            time.sleep(self._delay(attempt, r))
+
+    async def call_async(self, request, call_next):
+        import asyncio
+        for attempt in range(self.retries + 1):
+            r = None
+            try:
+                r = await call_next(request)
+                if attempt == self.retries or not self._retry(request, r):
+                    return r
+            except self.errors:
+                if attempt == self.retries or not self._retry(request, None):
+                    raise
+            await asyncio.sleep(self._delay(attempt, r))
+
+def _call_middleware(middleware, call_next, request):
+    return middleware(request, call_next)
+
+async def _call_middleware_async(middleware, call_next, request):
+    call = getattr(middleware, 'call_async', None)
+    result = call(request, call_next) if call is not None else middleware(request, call_next)
+    #Plain functions passing on call_next(request) return its coroutine
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+def _resolve(url):
+    """Look up the address of the host in a url"""
+    import socket
+    import urllib.parse
+    u = urllib.parse.urlsplit(url)
+    port = u.port or (443 if u.scheme == 'https' else 80)
+    return socket.getaddrinfo(u.hostname, port, type=socket.SOCK_STREAM)
+
+class Warmup:
+    """
+    Background warm-up started by setup() with "warmup" enabled, or warmup()
+
+    Steps run concurrently: resolving and connecting to the api host, fetching the
+    provider metadata and signing keys (also connecting to the provider) and starting the
+    token listener. Failed steps are recorded in .errors, they will just be repeated
+    when needed.
+
+    Parameters
+    ----------
+    hosts: tuple
+        (auth provider url, api url) being warmed up
+    """
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.timings = {} #Seconds taken by each step
+        self.errors = {}  #Error message for each failed step
+        self._threads = []
+
+    def _step(self, name, fn):
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            logging.debug("Warm-up step %s failed: %s", name, e)
+            self.errors[name] = str(e)
+        self.timings[name] = time.perf_counter() - start
+
+    def done(self):
+        """
+        Check if all the steps have finished
+
+        Returns
+        -------
+        boolean
+            True if complete
+        """
+        return not any(t.is_alive() for t in self._threads)
+
+    def wait(self, timeout_seconds=None):
+        """
+        Wait for the steps to finish
+
+        Parameters
+        ----------
+        timeout_seconds: int
+            Maximum seconds to wait, default is no limit
+
+        Returns
+        -------
+        dict
+            seconds taken by each completed step
+        """
+        deadline = None if timeout_seconds is None else time.time() + timeout_seconds
+        for t in self._threads:
+            t.join(None if deadline is None else max(0, deadline - time.time()))
+        return dict(self.timings)
+
+class LoginHandle:
+    """
+    Login started by connect_nowait(), can be waited on with .wait() or await
+
+    API calls wait on the login automatically when they need the token, so this
+    is only needed to check on or wait for the login explicitly.
+
+    Parameters
+    ----------
+    client: AuthClient
+        client being logged in
+    timeout_seconds: int
+        Seconds to wait for the login to complete before raising an exception
+    """
+    def __init__(self, client, timeout_seconds=300):
+        self.client = client
+        self.deadline = time.time() + timeout_seconds
+        self.settings = dict(client.settings) #Settings the login was started with
+
+    def done(self):
+        """
+        Check if the login has completed
+
+        Returns
+        -------
+        boolean
+            True if the token has been received
+        """
+        return self.client._token_event.is_set()
+
+    def _finish(self):
+        if self.done():
+            if self.client._pending is self:
+                self.client._pending = None
+            return True
+        if time.time() >= self.deadline:
+            #Stop waiting, the login can still complete later
+            if self.client._pending is self:
+                self.client._pending = None
+            raise(Exception("Timed out awaiting access token! "))
+        return False
+
+    def wait(self, timeout_seconds=None):
+        """
+        Block until the login completes
+
+        Parameters
+        ----------
+        timeout_seconds: int
+            Seconds to wait, default is to wait until the deadline given to connect_nowait()
+        """
+        if timeout_seconds is not None:
+            self.deadline = time.time() + timeout_seconds
+        self.client._token_event.wait(max(0, self.deadline - time.time()))
+        self._finish()
+
+    def __await__(self):
+        import asyncio
+        #Poll so the event loop (and anything else running on it) is not blocked
+        while not self._finish():
+            yield from asyncio.sleep(0.25).__await__()
+
+    def cancel(self):
+        """Stop waiting for the login and shut down the listener server"""
+        client = self.client
+        if client._pending is self:
+            client._pending = None
+        if client._server_loop is not None:
+            client._server_loop.call_soon_threadsafe(client._stop_background)
+
+class BrowserBatch:
+    """
+    Results of API calls made by the browser with call_api_js_batch()
+
+    Each result is a dict with the request "index", http "status" (0 if the request failed)
+    and the decoded json "data", or "text" if the response was not json, or "error"
+
+    Parameters
+    ----------
+    client: AuthClient
+        client that sent the requests
+    code: str
+        unique id of this batch
+    count: int
+        number of requests
+    timeout_seconds: int
+        Seconds to wait for the results before raising an exception
+    """
+    def __init__(self, client, code, count, timeout_seconds=60):
+        import queue
+        self.client = client
+        self.code = code
+        self.results = [None] * count
+        self.received = 0
+        self.deadline = time.time() + timeout_seconds
+        self._queue = queue.Queue()
+        self._pieces = {}
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def _add(self, items):
+        with self._lock:
+            for item in items:
+                i = item["index"]
+                if self.results[i] is None:
+                    self.results[i] = item
+                    self.received += 1
+                    self._queue.put(item)
+            finished = self.received == len(self.results) and not self._event.is_set()
+            if finished:
+                self._event.set()
+        if finished:
+            self.client._batch_done(self)
+
+    def _add_piece(self, part, seq, total, data):
+        import base64
+        with self._lock:
+            pieces = self._pieces.setdefault(part, {})
+            pieces[seq] = data
+            if len(pieces) < total:
+                return
+            del self._pieces[part]
+        encoded = ''.join(pieces[i] for i in range(total))
+        self._add(json.loads(base64.b64decode(encoded).decode('utf-8')))
+
+    def done(self):
+        """
+        Check if all the results have been received
+
+        Returns
+        -------
+        boolean
+            True if complete
+        """
+        return self._event.is_set()
+
+    def _check_deadline(self):
+        if time.time() >= self.deadline:
+            self.client._batch_done(self)
+            raise(Exception("Timed out awaiting browser results! {} of {} received".format(self.received, len(self.results))))
+
+    def result(self):
+        """
+        Wait for and get all the results
+
+        Returns
+        -------
+        list
+            result dicts, in the same order as the requests
+        """
+        if not self._event.wait(max(0, self.deadline - time.time())):
+            self._check_deadline()
+        return self.results
+
+    def as_completed(self):
+        """
+        Iterate over the results as they are received from the browser
+
+        Yields
+        ------
+        dict
+            result dict, use "index" to match to the request
+        """
+        import queue
+        for i in range(len(self.results)):
+            try:
+                yield self._queue.get(timeout=max(0, self.deadline - time.time()))
+            except queue.Empty:
+                self._check_deadline()
+
+    def __await__(self):
+        import asyncio
+        #Poll so the event loop is not blocked, results may arrive via a server on this loop
+        while not self.done():
+            self._check_deadline()
+            yield from asyncio.sleep(0.1).__await__()
+        return self.results
+
+class TokenHandle:
+    """
+    Reference to a token shared through a file, for use in worker processes
+
+    Get one from token_handle(), it only holds the file path and settings (no secrets)
+    so is cheap to pickle with every task. The token is read when a call is made and
+    renewals by the parent process are picked up automatically.
+
+    eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... handle = auth.token_handle()
+    ... def process(handle, task_id):
+    ...     return handle.call_api(f'/tasks/{task_id}/').json()
+    ... with ProcessPoolExecutor() as pool:
+    ...     results = list(pool.map(process, itertools.repeat(handle), task_ids))
+
+    Or install it as the default in each worker so the module level functions work:
+
+    >>> with ProcessPoolExecutor(initializer=handle.install) as pool:
+    ...     ...
+
+    Parameters
+    ----------
+    path: str
+        token file
+    settings: dict
+        client settings
+    """
+    def __init__(self, path, settings):
+        self.path = path
+        #Workers only make API calls, they don't login or run a listener
+        skip = ("default_baseurl", "warmup")
+        self.settings = {k: v for k, v in settings.items() if 'secret' not in k and k not in skip}
+        self.settings["warmup"] = False
+
+    def client(self):
+        """
+        Get the client for this handle, created once per process
+
+        Returns
+        -------
+        AuthClient
+            client reading the token from the shared file
+        """
+        #Include pid so forked workers don't share the parent's connections
+        key = (os.getpid(), self.path)
+        client = _handle_clients.get(key)
+        if client is None:
+            with _handle_lock:
+                client = _handle_clients.get(key)
+                if client is None:
+                    client = AuthClient(self.settings)
+                    client.use_token_file(self.path)
+                    _handle_clients[key] = client
+        return client
+
+    @property
+    def access_token(self):
+        """The current access token"""
+        return self.client().access_token
+
+    def call_api(self, url, data=None, throw=False, prefix=None):
+        """
+        Call an API endpoint with the shared token, see call_api()
+        """
+        return self.client().call_api(url, data, throw, prefix)
+
+    def install(self):
+        """
+        Make the module level functions in this process use the shared token,
+        eg: as a process pool initializer
+        """
+        _client.setup(self.settings)
+        _client.use_token_file(self.path)
+
+#Client credentials tokens, shared by all clients in the process until shortly before expiry
+#{(authurl, client_id, audience, scope) : (token_data, expires_at)}
+_machine_tokens = {}
+_machine_locks = {} #Lock for each key in _machine_tokens
+_machine_lock = threading.Lock() #Guards _machine_locks
+
+#Clients for token handles, one per process
+_handle_clients = {}
+_handle_lock = threading.Lock()
+
+def token_handle(path=None):
+    """
+    Share the token with worker processes (process pools, dask) through a file
+
+    The returned handle can be passed to tasks, see TokenHandle
+
+    Parameters
+    ----------
+    path: str
+        file to store the token in, default is a file in the user cache dir for the api audience and client
+
+    Returns
+    -------
+    TokenHandle
+        handle to pass to workers
+    """
+    return _client.token_handle(path)
+
 def setup(config=None):
     """Pass a dict with the authentication settings
 
@@ -92,28 +2252,41 @@ def setup(config=None):
     config: dict
         The configuration dict
     """
-    global settings
-    if config is None:
-        #Try and load from env variables
-        #(use os.environ dict which throws exception if key not found)
-        try:
-            settings["default_baseurl"] = os.environ['JUPYTERHUB_URL'] + '/user-redirect'
-            settings["api_audience"] = os.environ['JUPYTER_OAUTH2_API_AUDIENCE']
-            settings["api_client_id"] = os.environ['JUPYTER_OAUTH2_CLIENT_ID']
-            settings["api_scope"] = os.getenv('JUPYTER_OAUTH2_SCOPE', settings["api_scope"])
-            settings["api_authurl"] = os.environ['JUPYTER_OAUTH2_AUTH_PROVIDER_URL']
-            settings["token_prefix"] = os.getenv('JUPYTER_OAUTH2_PREFIX', settings["token_prefix"])
-            settings["provided"] = True
-        except Exception as e:
-            logging.error("Error loading settings from env: ", str(e))
-    else:
-        settings.update(config)
-        settings["provided"] = True
+    _client.setup(config)
+
+def warmup():
+    """
+    Prepare for the first login and API call in the background
+
+    Called by setup() if "warmup" is enabled in the settings (or env var JUPYTER_OAUTH2_WARMUP=1).
+    Concurrently resolves and connects to the auth provider ("api_authurl") and api ("api_audience") hosts,
+    fetches the provider metadata and signing keys and starts the token listener, so the
+    first connect() and call_api() don't wait for these.
+
+    eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... auth.setup({**config, "warmup": True})
+    ... #Later, to see how long each step took
+    ... print(auth.warmup_status().wait())
+
+    Returns
+    -------
+    Warmup
+        handle with the timing of each step
+    """
+    return _client.warmup()
+
+def warmup_status():
+    """
+    Get the warm-up started by setup()
 
-def _check_settings():
-    if not settings['provided']:
-        print('Please call .setup(dict) to configure before use, defaults are not usable:\n', settings)
-        raise(Exception('Settings not provided'))
+    Returns
+    -------
+    Warmup
+        handle with the timing of each step, or None if not started
+    """
+    return _client._warmup
 
 def get_url():
     """Attempt to get the Jupyter base url
@@ -121,40 +2294,7 @@ def get_url():
     This is difficult on the server side without callback from the browser client
     Needs to be set in env var ideally, can be overridden by settings above
     """
-    global settings, baseurl
-    _check_settings()
-    import subprocess
-    import json
-    import os
-    
-    #Get from env if set
-    server_url = os.getenv('JUPYTERHUB_URL')
-    if server_url:
-        baseurl = server_url + '/user-redirect'
-    else:
-        result = subprocess.run('jupyter notebook list --json'.split(), stdout=subprocess.PIPE)
-        res = result.stdout.decode().split('\n')
-
-        #Just take the longest path that is above os.getcwd() - not 100% reliable though
-        cwd = os.getcwd()
-        lastlen = 0
-        for r in res:
-            if not len(r): break
-            nbc = json.loads(r)
-            d = nbc["notebook_dir"]
-            if d in cwd and len(d) > lastlen:
-                nbconfig = nbc
-                lastlen = len(d)
-
-        if nbconfig['hostname'] == '0.0.0.0':
-            #Default for ASDC
-            baseurl = settings["default_baseurl"]
-        else:
-            #For localhost
-            baseurl = nbconfig['url']
-            if baseurl[-1] == '/':
-                baseurl = baseurl[0:-1] #Remove trailing /
-    logging.info("Base url: ", baseurl)
+    _client.get_url()
 
 async def check_server(url):
     """
@@ -165,10 +2305,9 @@ async def check_server(url):
     url: str
         url to test
     """
-    logging.info("Testing url: ", url)
+    logging.info("Testing url: %s", url)
 
-    import requests
-    r = requests.get(U)
+    r = requests.get(url)
 
     if r.status_code >= 400:
         logging.info("Server responded error: {} {}".format(r.status_code, r.reason))
@@ -176,200 +2315,6 @@ async def check_server(url):
     else:
         logging.info("Server responded OK: {} {}\n{}".format(r.status_code, r.reason, r.text))
 
-def _serve():
-    """
-    Listen for the token passed by browser on client side
-    (Tried using websockets here, but wss: connections are not handled by jupyter-server-proxy)
-    
-    See: https://notebook.community/knowledgeanyhow/notebooks/hacks/Webserver%20in%20a%20Notebook
-    """
-    global settings, port, token_data, _server
-    import tornado.ioloop
-    import tornado.web
-    import tornado.httpserver
-
-    def set_token(data, verify=True):
-        global nonce, token_data
-        logging.debug("Verfifying, nonce: ", nonce, ", verify enabled: ",verify)
-        if verify and data['id_token']['nonce'] != nonce:
-            logging.error("INVALID TOKEN! Nonce does not match")
-            token_data = None
-        else:
-            if verify:
-                logging.debug("==> TOKEN VALIDATED!")
-            else:
-                logging.debug("==> TOKEN Reused, already validated")
-            token_data = data
-
-    class MainHandler(tornado.web.RequestHandler):
-        def get(self):
-            #'''Renders the template with a title on HTTP GET.'''
-            #self.finish(page.render(title='Tornado Demo'))
-            #Just confirm server is running
-            self.finish('OK')
-
-    class TokenHandler(tornado.web.RequestHandler):
-        def post(self):
-            import json
-            data = self.request.body
-            t = json.loads(data)
-            logging.debug("==> TOKEN RECEIVED via POST")
-            set_token(t)
-            self.finish("Token processed")
-
-        def get(self):
-            import json
-            import base64
-            logging.debug("==> TOKEN RECEIVED via GET")
-            data = self.get_argument("data", default=None, strip=False)
-            verify = self.get_argument("verify", default="True", strip=False)
-            t = json.loads(base64.b64decode(data).decode('utf-8'))
-            set_token(t, verify == "True") #Can't verify when reusing token as nonce may have been cleared
-            self.finish("Token processed")
-
-    application = tornado.web.Application([
-        (r"/", MainHandler),
-        (r"/token", TokenHandler)
-    ])
-
-    #Selects a random port by default,
-    #allowing multiple notebooks to use this without conflicts
-    _server = tornado.httpserver.HTTPServer(application)
-    _server.listen(port, '0.0.0.0')
-    
-    #Get the actual port assigned
-    if port is None:
-        #(First entry in _sockets)
-        socket = _server._sockets[next(iter(_server._sockets))]
-        port = socket.getsockname()[1]
-
-    logging.debug("Running on port: ", port) 
-
-def _listener():
-    """ Setup the listener to receive reponse message posted from popup or iframe
-    that processes the oauth2 request
-    """
-    global settings, baseurl, port, access_token, token_data
-    if not baseurl: get_url()
-    from IPython.display import display, HTML
-    from string import Template
-    temp_obj = Template("""
-    <script>
-    //Have the token, send back to server with HTTP POST
-    function postToken_$PORT(data) {
-        var xhr = new XMLHttpRequest();
-        xhr.open("POST", '$BASEURL/proxy/$PORT/token', true);
-        //Send the proper header information along with the request
-        xhr.setRequestHeader("Content-Type", "application/json");
-        xhr.onload = function() {console.log('postToken successful');}
-        xhr.send(JSON.stringify(data));
-    }
-
-    //Have the token, send back to server with HTTP GET
-    function postTokenGET_$PORT(data, reuse) {
-        var xhr = new XMLHttpRequest();
-        var encoded = window.btoa(JSON.stringify(data));
-        var uri = '$BASEURL/proxy/$PORT/token?data=' + encoded;
-        if (reuse)
-            uri += '&verify=False';
-        xhr.open("GET", uri);
-        xhr.onload = function() {console.log('postTokenGET successful');}
-        xhr.send();
-    }
-
-    //Get message from iframe or popup
-    function message_received(event) {
-        //console.log("ORIGIN:" + event.origin);
-        //console.log("MESSAGE:" + JSON.stringify(event.data));
-        if ("access_token" in event.data) {
-            //Save token on client side
-            window.token = event.data;
-
-            //POST gets 405 method not allowed on jupyterhub
-            //postToken_$PORT(event.data);
-            postTokenGET_$PORT(event.data);
-
-            //Stop listening after sending token
-            window.removeEventListener('message', self);
-            //window.listenerExists = false;
-        }
-    }
-    window.addEventListener("message", message_received);
-    </script>
-    """)
-    script = temp_obj.substitute(BASEURL=baseurl, PORT=str(port))
-    display(HTML(script))
-
-def _send(mode='popup'):
-    """ Open auth request page with iframe / popup / link and listen for postMessage 
-    
-    Parameters
-    ----------
-    mode : str
-        'popup' opens page in new window/tab (may require disabling popup blockers)
-        'iframe' opens page in inline iframe (this seems less reliable)
-        'link' displays link to the auth page without opening it automatically
-    """
-    import urllib
-    #This uses jupyter-server-proxy entry-point magic to provide a consistent callback url
-    #(package jupyter_oauth2 must be installed: pip install git+https://github.com/AuScalableDroneCloud/jupyter_oauth2.git)
-    redirect = baseurl + '/jupyter_oauth2/callback'
-    import secrets
-    global nonce, port
-    nonce = secrets.token_urlsafe(nbytes=8)
-    f = {'response_type' : 'token id_token',
-         'redirect_uri' : redirect,
-         'client_id' : settings["api_client_id"],
-         'audience' : settings["api_audience"],
-         'scope' : settings["api_scope"],
-         'nonce' : nonce,
-         'state' : 'auth0,' + nonce,
-         #'state' : 'auth0,iframe,' + nonce,
-         #'state' : 'auth0,popup,' + nonce,
-         #'prompt' : 'none'}
-        }
-    logging.debug("Auth query params: ", f)
-    #print("Auth query params: ", f)
-    query = urllib.parse.urlencode(f)
-    authurl = settings["api_authurl"] + '/authorize?' + query
-
-    from IPython.display import HTML
-    from string import Template
-    temp_obj = Template("""<script>
-    //This code only has 10 seconds to run after the output produced
-    //(Prevents re-running from saved notebook output)
-    var now = new Date().getTime();
-    var ts = new Date(document.getElementById('$ID').dataset.timestamp * 1000);
-    if (now - ts < 10000) {
-        var mode = "$MODE";
-        var now = new Date().valueOf();
-        if (window.token) console.log("Token expired?: " + window.token['id_token']['exp']*1000 + ' > ' + now);
-        if (window.token && window.token['id_token']['exp']*1000 > now) {
-            //Use saved token on client side
-            postTokenGET_$PORT(window.token, true); //Pass re-use flag to skip verification
-        } else {
-            var html = '';
-            if (mode == 'popup') {
-                window.open("$URL");
-                html += '(Authentication window may not appear if you have a popup blocker, <a href="$URL" target="_blank" rel="opener">Click here to login</a> instead)';
-            } else if (mode == 'iframe') {
-                html = '<iframe src="$URL" width="0px" height="0px">';
-            } else if (mode == 'iframe_debug') {
-                html = '<iframe src="$URL" width="400px" height="300px" style="border:1px solid #ccc;">';
-            } else if (mode == 'link') {
-                html += '<h3><a href="$URL" target="_blank" rel="opener">Click here to login</a></h3>';
-            }
-            document.getElementById('$ID').innerHTML = html;
-        }
-    } else {
-      console.log("Fragment expired, skipping run: " + new Date(now).toUTCString() + " : " + new Date(ts).toUTCString());
-    }
-    </script>
-    <div id="$ID" data-timestamp="$NOW"></div>
-    """)
-    script = temp_obj.substitute(URL=authurl, ID="auth_" + nonce, MODE=mode, PORT=port, NOW=str(int(time.time())))
-    display(HTML(script))
-
 def is_notebook():
     """
     Detects if running within an interactive IPython notebook environment
@@ -427,67 +2372,50 @@ async def connect(config=None, mode='popup', timeout_seconds=30, scope=""):
     scope : str
         Any additional scopes to append to default list ('openid profile email' unless overridden)
     """
-    global settings, access_token, token_data, _server
-    if config is not None:
-        setup(config)
-    _check_settings()
-
-    if scope is not None:
-        settings["api_scope"] += " " + scope
+    await _client.connect(config, mode, timeout_seconds, scope)
 
-    #Have a token already? Check if it is expired
-    if token_data:
-        ts = int(token_data['id_token']['exp'])
-        dt = datetime.datetime.fromtimestamp(ts)
-        now = datetime.datetime.now(tz=None)
-        #print(dt.strftime("%d/%m/%Y %H:%M:%S"))
-        #print(now.strftime("%d/%m/%Y %H:%M:%S"))
+def connect_nowait(config=None, mode='popup', timeout_seconds=300, scope=""):
+    """
+    Start authenticating with the OAuth2 id provider and return immediately
 
-        #Renew expired token
-        if dt <= now:
-            token_data = None
+    Like connect() but does not wait for the user to complete the login,
+    other cells can run while the login happens. The token is received by a server
+    running in a background thread and call_api(), call_api_async() and userinfo()
+    wait on the login only when they are called before it completes.
 
-    #Setup the server, listener and send the auth request
-    if not token_data:
-        _serve()
-        _listener()
-        _send(mode)
+    eg:
 
-        import asyncio
-        import time
-        import sys
-        print('Waiting for authorisation', end='')
-        for i in range(0,timeout_seconds*4): #4 ticks per second
-            #Have the token yet?
-            if token_data: break
-            #Async sleep to allow server to process requests
-            await asyncio.sleep(0.25)
-            #Blocking sleep to actually pause processing
-            time.sleep(0.25)
-            #Visual feedback
-            print('.', end='')
-            sys.stdout.flush()
-    
-        if not token_data:
-            raise(Exception("Timed out awaiting access token! "))
-        else:
-            print('.. success.')
+    >>> import jupyter_oauth2_api as auth
+    ... login = auth.connect_nowait(config)
+    ... data = load_data() #Runs while the user logs in
+    ... r = auth.call_api('/projects/') #Waits for the login if not yet complete
 
-        access_token = token_data['access_token']
+    Parameters
+    ----------
+    config: dict
+        The configuration dict, required if .setup() has not yet been called to
+        provide the settings.
+    mode : str
+        'popup' opens page in new window/tab (may require disabling popup blockers)
+        'iframe' opens page in inline iframe (this seems to be unreliable)
+        'link' displays link to the auth page without opening it automatically
+    timeout_seconds: int
+        Seconds API calls will wait for the login to complete before raising an exception
+    scope : str
+        Any additional scopes to append to default list ('openid profile email' unless overridden)
 
-        await stop_server()
-    else:
-        print('Already have a valid token')
+    Returns
+    -------
+    LoginHandle
+        handle to check on or wait for the login with .done(), .wait() or await
+    """
+    return _client.connect_nowait(config, mode, timeout_seconds, scope)
 
 async def stop_server():
     """Stop the server
     Called automatically upon recieving token except in case of timeout
     """
-    global _server, port
-    await _server.close_all_connections()
-    _server.stop()
-    _server = None
-    port = None
+    await _client.stop_server()
 
 def device_connect(config=None, qrcode=True, scope=""):
     """
@@ -510,7 +2438,7 @@ def device_connect(config=None, qrcode=True, scope=""):
     eg:
 
     >>> import jupyter_oauth2_api as auth
-    ... await auth.connect_device({"api_audience": 'https://MYSITE/api',
+    ... auth.device_connect({"api_audience": 'https://MYSITE/api',
     ...    "api_client_id": 'CLIENT_ID_HERE',
     ...    "api_scope": 'openid profile email',
     ...    "api_authurl": 'MY_OAUTH2_PROVIDER_URL'
@@ -528,91 +2456,57 @@ def device_connect(config=None, qrcode=True, scope=""):
     scope : str
         Any additional scopes to append to default list ('openid profile email' unless overridden)
     """
-    global settings, access_token, token_data, _server
-    if config is not None:
-        setup(config)
-    _check_settings()
+    _client.device_connect(config, qrcode, scope)
 
-    if scope is not None:
-        settings["api_scope"] += " " + scope
+def client_connect(config=None, scope=""):
+    """
+    Authenticate with the OAuth2 id provider using the client credentials flow
 
-    if qrcode:
-        #Disable qrcode if module not installed
-        try:
-            import io
-            import qrcode
-            from PIL import Image
-        except (ImportError) as e:
-            qrcode = False
-            pass
+    For scheduled / batch jobs where there is no user to login, this requires a
+    machine to machine application and its client secret, no browser or server is used.
+    Tokens are cached for the process and renewed automatically by call_api() shortly
+    before they expire ("token_leeway" seconds).
 
-    headers = {
-        "content-type": "application/x-www-form-urlencoded",
-    }
-    data = {
-        "client_id": settings['api_client_id'],
-        "scope": settings['api_scope'],
-        "audience": settings['api_audience']
-    }
-
-    AUTH_DOMAIN = settings['api_authurl']
-    response = requests.post(f"{AUTH_DOMAIN}/oauth/device/code", headers=headers, data=data)
-    if response.status_code >= 500 or "error" in response.json():
-        print(response.json())
-        exit()
-
-    logging.info(response.json())
-    user_code = response.json()["user_code"]
-    verify_url = response.json()["verification_uri_complete"]
-    device_code = response.json()["device_code"]
-    if is_notebook():
-        from IPython.display import display, HTML
+    Enable by setting "auth_flow" to 'client_credentials' and providing "api_client_secret",
+    or setting env vars JUPYTER_OAUTH2_FLOW=client_credentials and JUPYTER_OAUTH2_CLIENT_SECRET,
+    connect() and device_connect() will then also use this flow.
 
-        display(f"Click link below to authenticate (verify code={user_code})")
-        display(HTML(f'<h1>{user_code}</h1><a href="{verify_url}" target="_blank">{verify_url}</a>'))
-        if qrcode:
-            qr = qrcode.make(verify_url, box_size=5)
-            display(qr)
-    else:
-        print(f"Click or copy link below to authenticate (verify code={user_code})")
-        print(" _______________ ")
-        print("|               |")
-        print('|   \033[1m' + user_code + '\033[0m   |')
-        print("|_______________|\n")
-        print(verify_url)
-        if qrcode:
-            qr = qrcode.QRCode()
-            qr.add_data(verify_url)
-            qr.print_ascii()
-
-    headers2 = {
-        "content-type": "application/x-www-form-urlencoded",
-    }
-    data2 = {
-        "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
-        "device_code": device_code,
-        "client_id": settings['api_client_id'],
-    }
-
-    logged_in = False
-    token = {}
-    while not logged_in:
-        time.sleep(2)
-        token = requests.post(f"{AUTH_DOMAIN}/oauth/token", headers=headers2, data=data2)
-        if token.status_code == 200:
-            if is_notebook():
-                from IPython.display import display
-
-                display(f"Successfully authenticated!")
-            else:
-                print("Successfully authenticated!")
-                logged_in = True
-        token_json = token.json()
-        if "access_token" in token_json:
-            access_token = token_json["access_token"]
-            break
+    eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... auth.client_connect({"api_audience": 'https://MYSITE/api',
+    ...    "api_client_id": 'CLIENT_ID_HERE',
+    ...    "api_client_secret": 'CLIENT_SECRET_HERE',
+    ...    "api_authurl": 'MY_OAUTH2_PROVIDER_URL',
+    ...    "auth_flow": 'client_credentials'
+    ...   })
+    ... r = auth.call_api('/projects/')
 
-def call_api(url, data=None, throw=False, prefix=settings["token_prefix"]):
+    Parameters
+    ----------
+    config: dict
+        The configuration dict, required if .setup() has not yet been called to
+        provide the settings.
+    scope : str
+        Scopes to request, default is the scopes granted to the application
+    """
+    _client.client_connect(config, scope)
+
+def refresh(refresh_token=None):
+    """
+    Get a new access token using a refresh token
+
+    Refresh tokens are only issued if the 'offline_access' scope is requested
+    (and allowed for the application), eg: device_connect(scope="offline_access")
+
+    Parameters
+    ----------
+    refresh_token: str
+        refresh token to use, default is the one received with the current token
+    """
+    _client.refresh(refresh_token)
+
+def call_api(url, data=None, throw=False, prefix=None):
     """
     Call an API endpoint
 
@@ -624,41 +2518,176 @@ def call_api(url, data=None, throw=False, prefix=settings["token_prefix"]):
         json data for a POST request, if omitted will send a GET request
     throw: bool
         throw exception on http errors, default: False
+    prefix: str
+        token prefix for the Authorization header, default: "token_prefix" from settings
 
     Returns
     -------
     object
         http response object
     """
-    global access_token
-    if url[0:4] != "http":
-        #Prepend the configured api url
-        url = settings["api_audience"] + url
-
-    #WebODM api call
-    headersAPI = {
-    'accept': 'application/json',
-    'Content-type': 'application/json',
-    'Authorization': prefix + ' ' + access_token if access_token else '',
-    }
-    
-    #POST if data provided, otherwise GET
-    if data:
-        r = requests.post(url, headers=headersAPI, json=data)
-    else:
-        r = requests.get(url, headers=headersAPI)
-    
-    #Note: if response is 403 Forbidden {'detail': 'Username not available'}
-    # this is because the user hasn't logged in to the main site yet with this auth method
-    # (ie: originally logged in with github, use AAF to auth with jupyter)
-    if r.status_code >= 400:
-        print(r.status_code, r.reason)
-        if throw:
-            raise(Exception("Error response from server!"))
-    #print(r.text)
-    return r
+    return _client.call_api(url, data, throw, prefix)
 
-def call_api_js(url, callback="alert()", data=None, prefix=settings["token_prefix"]):
+def call_api_json(url, data=None, throw=False, prefix=None):
+    """
+    Call an API endpoint and decode the json response
+
+    Decodes with the configured codec (see set_json_codec()), the decode time is
+    recorded in get_metrics()
+
+    Parameters
+    ----------
+    url: str
+        endpoint url, either full uri or path / which will be appended to "api_audience" url from settings
+    data: dict
+        json data for a POST request, if omitted will send a GET request
+    throw: bool
+        throw exception on http errors, default: False
+    prefix: str
+        token prefix for the Authorization header, default: "token_prefix" from settings
+
+    Returns
+    -------
+    object
+        decoded json data
+    """
+    return _client.call_api_json(url, data, throw, prefix)
+
+def iter_api_items(url, path='item', data=None, prefix=None, chunk_size=65536):
+    """
+    Call an API endpoint and iterate over the items of a json array in the response as it is received
+
+    The response is parsed incrementally, so memory use is proportional to a single item
+    rather than the whole response, for very large list responses.
+    Raises an exception on http errors.
+
+    eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... for image in auth.iter_api_items('/projects/1/tasks/2/images/'):
+    ...     print(image['filename'])
+    ... #Array inside an object: {"count": 1000, "results": [...]}
+    ... for gcp in auth.iter_api_items('/gcps/', path='results.item'):
+    ...     process(gcp)
+
+    Parameters
+    ----------
+    url: str
+        endpoint url, either full uri or path / which will be appended to "api_audience" url from settings
+    path: str
+        location of the array in the response, dot separated object keys ending with "item",
+        default "item" is a top level array (ijson prefix syntax, install ijson for paths through nested arrays)
+    data: dict
+        json data for a POST request, if omitted will send a GET request
+    prefix: str
+        token prefix for the Authorization header, default: "token_prefix" from settings
+    chunk_size: int
+        bytes to read from the response at a time
+
+    Yields
+    ------
+    object
+        decoded json item
+    """
+    yield from _client.iter_api_items(url, path, data, prefix, chunk_size)
+
+def add_middleware(middleware, index=None):
+    """
+    Add a layer to the request/response middleware chain used by call_api() and call_api_async()
+
+    Layers are called in the order added with the ApiRequest (method, url, headers, body)
+    and a call_next function that passes the request on and returns the response.
+    Use a Middleware subclass to work with both call_api() and call_api_async(),
+    or a plain function for call_api() only. When there are no layers there is no overhead.
+    (iter_api_items() streams the response so does not use the chain)
+
+    eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... def trace(request, call_next):
+    ...     start = time.time()
+    ...     r = call_next(request)
+    ...     print(request.method, request.url, r.status_code, time.time() - start)
+    ...     return r
+    ... auth.add_middleware(trace)
+    ... auth.add_middleware(auth.RetryMiddleware(retries=3))
+
+    Parameters
+    ----------
+    middleware: object
+        Middleware instance or function(request, call_next)
+    index: int
+        position in the chain, default is to add to the end (closest to the transport)
+    """
+    _client.add_middleware(middleware, index)
+
+def remove_middleware(middleware):
+    """
+    Remove a layer from the middleware chain
+
+    Parameters
+    ----------
+    middleware: object
+        middleware previously passed to add_middleware()
+    """
+    _client.remove_middleware(middleware)
+
+def set_json_codec(dumps=None, loads=None):
+    """
+    Set the functions used to encode request and decode response json
+
+    Parameters
+    ----------
+    dumps: function
+        object to json str or bytes, default is the json module (pass orjson.dumps for speed)
+    loads: function
+        json str or bytes to object, default is the json module (pass orjson.loads for speed)
+    """
+    _client.set_json_codec(dumps, loads)
+
+def get_metrics():
+    """
+    Get API call transfer metrics
+
+    Includes bytes sent / received and saved by compression, and json decode time
+
+    Returns
+    -------
+    dict
+        copy of the current metrics
+    """
+    with _client._metrics_lock:
+        return dict(_client.metrics)
+
+def reset_metrics():
+    """Reset API call transfer metrics"""
+    _client.reset_metrics()
+
+async def call_api_async(url, data=None, throw=False, prefix=None):
+    """
+    Call an API endpoint without blocking the event loop, use with await
+
+    The request is run in a thread, waits on a login started by connect_nowait() if required
+
+    Parameters
+    ----------
+    url: str
+        endpoint url, either full uri or path / which will be appended to "api_audience" url from settings
+    data: dict
+        json data for a POST request, if omitted will send a GET request
+    throw: bool
+        throw exception on http errors, default: False
+    prefix: str
+        token prefix for the Authorization header, default: "token_prefix" from settings
+
+    Returns
+    -------
+    object
+        http response object
+    """
+    return await _client.call_api_async(url, data, throw, prefix)
+
+def call_api_js(url, callback="alert()", data=None, prefix=None):
     """
     Call an API endpoint from the browser via Javascript, appends a script to the page to 
     do the request.
@@ -671,58 +2700,45 @@ def call_api_js(url, callback="alert()", data=None, prefix=settings["token_prefi
         javascript code defining a callback function
     data: dict
         json data for a POST request, if omitted will send a GET request
+    prefix: str
+        token prefix for the Authorization header, default: "token_prefix" from settings
     """
-    #GET, list nodes, passing url and token from python
-    from IPython.display import display, HTML
-    #Generate a code to prevent this call happening again if page reloaded without clearing
-    import string
-    import secrets
-    alphabet = string.ascii_letters + string.digits
-    code = "req_" + ''.join(secrets.choice(alphabet) for i in range(8))
-    method = "POST"
-    if data is None:
-        method = "GET"
-        data = {}
-    from string import Template
-    temp_obj = Template("""<script>
-    //Prevent multiple calls
-    if (!window._requests) 
-      window._requests = {};
-    if (!window._requests["$CODE"]) {
-        var data = $DATA;
-        var callback = $CALLBACK;
-        var xhr = new XMLHttpRequest();
-        xhr.open("$METHOD", "$URL");
-        xhr.setRequestHeader("Authorization", "$PREFIX $TOKEN");
-        //Can also just grab it from window...
-        //xhr.setRequestHeader("Authorization", "$PREFIX " + window.token['access_token']);
-        xhr.responseType = 'json';
-        xhr.onload = function() {
-            // Request finished. Do processing here.
-            var data = xhr.response;
-            console.log('success');
-            callback(xhr.response);
-        }
+    _client.call_api_js(url, callback, data, prefix)
 
-        if (data && Object.keys(data).length) {
-            var formData = new FormData();
-            for (var key in data)
-                formData.append(key, data[key]);
+def call_api_js_batch(calls, concurrency=6, timeout_seconds=60, prefix=None):
+    """
+    Call a list of API endpoints from the browser and get the results back in python
 
-            xhr.send(formData);
-        } else {
-            xhr.send();
-        }
+    All the requests are sent in one script, run in parallel with fetch() by the browser and
+    the json results are passed back to the kernel through the token listener server as they complete.
+    Useful where the browser has a faster or privileged network path to the API.
 
-        //Flag request sent
-        window._requests["$CODE"] = true;
-    }
-    </script>
-    """)
-    script = temp_obj.substitute(DATA=json.dumps(data),
-                CODE=code, METHOD=method, URL=url,
-                TOKEN=access_token, PREFIX=prefix, CALLBACK=callback)
-    display(HTML(script))
+    eg:
+
+    >>> import jupyter_oauth2_api as auth
+    ... batch = auth.call_api_js_batch(['/projects/', '/projects/1/tasks/', ('/projects/', {'name': 'New'})])
+    ... for r in batch.result():
+    ...     print(r["status"], r["data"])
+
+    Parameters
+    ----------
+    calls: list
+        endpoint urls, (url, data) tuples or {"url": url, "data": data} dicts.
+        url is either full uri or path / which will be appended to "api_audience" url from settings,
+        data is json data for a POST request, if omitted will send a GET request
+    concurrency: int
+        maximum number of requests the browser runs at once
+    timeout_seconds: int
+        Seconds to wait for the results before raising an exception
+    prefix: str
+        token prefix for the Authorization header, default: "token_prefix" from settings
+
+    Returns
+    -------
+    BrowserBatch
+        handle to get the results with .result(), .as_completed() or await
+    """
+    return _client.call_api_js_batch(calls, concurrency, timeout_seconds, prefix)
 
 def userinfo():
     """
@@ -733,17 +2749,10 @@ def userinfo():
     dict
         json dict containing user info
     """
-    r = call_api(settings["api_authurl"] + '/userinfo') #, prefix='Bearer')
-    data = r.json()
-    return data
+    return _client.userinfo()
 
 def showuserinfo():
     """
     Call the userinfo API from Auth0 and display username/email and avatar image inline
     """
-    user = userinfo()
-    #print(json.dumps(user, indent=4, sort_keys=True))
-    print("Username: ", user["name"])
-    from IPython.display import display, HTML
-    display(HTML("<img src='" + user["picture"] + "' width='120' height='120'>"))
-
+    _client.showuserinfo()
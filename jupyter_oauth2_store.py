@@ -0,0 +1,172 @@
+"""
+File backed token store
+
+Tokens are written here so other processes on the same machine (process pool and dask workers,
+command line tools) can read them without logging in again.
+This module only uses the standard library so it is fast to import.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+def cache_dir():
+    """
+    Get the directory to store cached tokens and provider data
+
+    Uses $JUPYTER_OAUTH2_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/jupyter_oauth2 or ~/.cache/jupyter_oauth2
+
+    Returns
+    -------
+    str
+        directory path
+    """
+    path = os.getenv('JUPYTER_OAUTH2_CACHE_DIR')
+    if not path:
+        base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(base, 'jupyter_oauth2')
+    return path
+
+def cache_path(kind, key):
+    """
+    Get the cache file path for a key
+
+    Parameters
+    ----------
+    kind: str
+        type of data cached, used as the sub directory, eg: "tokens"
+    key: str
+        key identifying the data, eg: a url
+
+    Returns
+    -------
+    str
+        file path
+    """
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest()[0:16]
+    return os.path.join(cache_dir(), kind, name + '.json')
+
+def token_path(audience, client_id='', authurl=''):
+    """
+    Get the token file path for an api audience, client and auth provider
+
+    Tokens are stored separately for each combination so logins with different
+    clients or providers for the same api don't replace each other
+
+    Parameters
+    ----------
+    audience: str
+        api audience url, "api_audience" from settings
+    client_id: str
+        "api_client_id" from settings
+    authurl: str
+        auth provider url, "api_authurl" from settings
+
+    Returns
+    -------
+    str
+        file path
+    """
+    return cache_path('tokens', ' '.join((authurl.rstrip('/'), client_id, audience)))
+
+def write_json(path, data):
+    """
+    Atomically write json data to a file readable only by the current user
+
+    Readers never see a partially written file as it is written to a temp file then renamed
+
+    Parameters
+    ----------
+    path: str
+        file path
+    data: dict
+        json data to write
+    """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def read_json(path):
+    """
+    Read json data from a file
+
+    Parameters
+    ----------
+    path: str
+        file path
+
+    Returns
+    -------
+    dict
+        json data or None if the file does not exist or is invalid
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class TokenFile:
+    """
+    Token stored in a file, only re-read when the file changes
+
+    Parameters
+    ----------
+    path: str
+        file path
+    """
+    def __init__(self, path):
+        self.path = path
+        self._stamp = None
+        self._data = None
+
+    def load(self):
+        """
+        Get the stored token record, checks the file modification time on each call
+        so renewed tokens are picked up
+
+        Returns
+        -------
+        dict
+            {"token_data": dict, "expires_at": float} or None if no token stored yet
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._stamp = self._data = None
+            return None
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp != self._stamp:
+            self._data = read_json(self.path)
+            self._stamp = stamp
+        return self._data
+
+    def save(self, token_data, expires_at=None):
+        """
+        Store a token record
+
+        Parameters
+        ----------
+        token_data: dict
+            token data as received from the provider
+        expires_at: float
+            expiry timestamp, if known
+        """
+        write_json(self.path, {"token_data": token_data, "expires_at": expires_at})
+
+    def clear(self):
+        """Remove the stored token"""
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self._stamp = self._data = None
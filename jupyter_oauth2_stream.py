@@ -0,0 +1,221 @@
+"""
+Incremental json parsing
+
+Yields the items of an array inside a json document as the data arrives, so memory use
+is proportional to a single item rather than the whole document.
+Uses ijson if installed, otherwise a built in parser that supports paths of object keys
+ending in an array (eg: "item" or "results.item").
+"""
+
+import re
+import json
+import codecs
+
+_WS = re.compile(r'[ \t\r\n]*')
+_STRUCT = re.compile(r'["{}\[\]]')
+_STR_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[,\]} \t\r\n]')
+
+def iter_items(chunks, path='item', loads=json.loads):
+    """
+    Iterate over the items at a path in json data received in chunks
+
+    Parameters
+    ----------
+    chunks: iterable
+        bytes chunks of the json document
+    path: str
+        ijson style prefix, dot separated object keys where "item" is an array element,
+        eg: "item" for a top level array or "results.item" for the array in {"results": [...]}
+    loads: function
+        json decoder used for each item (ignored if ijson is installed)
+
+    Yields
+    ------
+    object
+        decoded item
+    """
+    try:
+        import ijson
+    except ImportError:
+        yield from _iter_items(chunks, path, loads)
+        return
+
+    events = ijson.sendable_list()
+    coro = ijson.items_coro(events, path, use_float=True)
+    for chunk in chunks:
+        coro.send(chunk)
+        yield from events
+        del events[:]
+    coro.close()
+    yield from events
+
+def _iter_items(chunks, path, loads):
+    keys = path.split('.') if path else []
+    if not keys or keys[-1] != 'item' or 'item' in keys[:-1]:
+        raise ValueError("Unsupported path '{}', install ijson for nested arrays".format(path))
+    reader = _Reader(chunks)
+    for key in keys[:-1]:
+        if not reader.find_key(key):
+            return
+    for text in reader.array_items():
+        yield loads(text)
+
+class _Scanner:
+    """Finds the end of a json value, can be resumed when more data arrives"""
+    def __init__(self):
+        self.started = False
+        self.scalar = False
+        self.in_str = False
+        self.depth = 0
+        self.next = 0 #Where to resume scanning
+
+    def scan(self, buf, i):
+        """Returns index after the end of the value starting at (or resuming from) i, or -1 if more data needed"""
+        if not self.started:
+            self.started = True
+            c = buf[i]
+            if c == '"':
+                self.in_str = True
+                i += 1
+            elif c in '{[':
+                self.depth = 1
+                i += 1
+            else:
+                self.scalar = True
+        if self.scalar:
+            m = _SCALAR_END.search(buf, i)
+            if m is None:
+                self.next = len(buf)
+                return -1
+            return m.start()
+        while True:
+            if self.in_str:
+                m = _STR_SPECIAL.search(buf, i)
+                if m is None:
+                    self.next = len(buf)
+                    return -1
+                i = m.start()
+                if buf[i] == '\\':
+                    if i + 1 >= len(buf):
+                        self.next = i
+                        return -1
+                    i += 2
+                    continue
+                self.in_str = False
+                i += 1
+                if self.depth == 0:
+                    return i
+            else:
+                m = _STRUCT.search(buf, i)
+                if m is None:
+                    self.next = len(buf)
+                    return -1
+                i = m.start()
+                c = buf[i]
+                i += 1
+                if c == '"':
+                    self.in_str = True
+                elif c in '{[':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return i
+
+class _Reader:
+    """Pulls text from the chunks as needed, only keeps data from the current value onwards"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        """Read more data, drops the buffer before pos, returns False at end of data"""
+        if self.eof:
+            return False
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        self.eof = True
+        self.decoder.decode(b'', final=True) #Raises if truncated mid character
+        return False
+
+    def _peek(self):
+        """Next non whitespace character, without consuming it"""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of json data")
+
+    def _expect(self, c):
+        found = self._peek()
+        if found != c:
+            raise ValueError("Invalid json, expected '{}' found '{}'".format(c, found))
+        self.pos += 1
+
+    def _value(self, keep=True):
+        """Consume the value at pos, returns its text if keep, otherwise the data is discarded as it is read"""
+        self._peek()
+        scanner = _Scanner()
+        i = self.pos
+        while True:
+            end = scanner.scan(self.buf, i)
+            if end >= 0:
+                break
+            if keep:
+                offset = scanner.next - self.pos
+            else:
+                #Only the scanner state is needed to find the end
+                offset = 0
+                self.pos = scanner.next
+            if not self._more():
+                if scanner.scalar:
+                    end = len(self.buf)
+                    break
+                raise ValueError("Unexpected end of json data")
+            i = self.pos + offset
+        text = self.buf[self.pos:end] if keep else None
+        self.pos = end
+        return text
+
+    def find_key(self, key):
+        """Move to the value of key in the object at pos, returns False if not found"""
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return False
+        while True:
+            k = json.loads(self._value())
+            self._expect(':')
+            if k == key:
+                return True
+            self._value(keep=False)
+            c = self._peek()
+            self.pos += 1
+            if c == '}':
+                return False
+            if c != ',':
+                raise ValueError("Invalid json, expected ',' or '}}' found '{}'".format(c))
+
+    def array_items(self):
+        """Iterate over the text of each element of the array at pos"""
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            c = self._peek()
+            self.pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError("Invalid json, expected ',' or ']' found '{}'".format(c))
@@ -0,0 +1,116 @@
+"""
+Command line token helper
+
+Prints the access token saved by a notebook login (or any other use of jupyter_oauth2_api)
+so shell scripts and other tools can reuse it, eg:
+
+    curl -H "$(jupyter-oauth2-token --header)" https://MYSITE/api/projects/
+
+The token is read from the local token store, only if it is missing or about to expire is it
+renewed (with a refresh token or client credentials if available) or a device login started.
+Settings are read from the same environment variables as jupyter_oauth2_api.setup().
+
+Reading from the store only needs the standard library, jupyter_oauth2_api is
+imported only when a new token is needed, so this answers in milliseconds.
+"""
+
+import os
+import sys
+import time
+import argparse
+import jupyter_oauth2_store
+
+def _valid(record, leeway):
+    if not record or not record.get("token_data") or not record["token_data"].get("access_token"):
+        return False
+    expires_at = record.get("expires_at")
+    return expires_at is None or expires_at - leeway > time.time()
+
+def _renew(args, record, login):
+    """Get a new token, returns the token data"""
+    import contextlib
+    import jupyter_oauth2_api
+    #Command line options replace the env variables before the settings are loaded
+    os.environ['JUPYTER_OAUTH2_API_AUDIENCE'] = args.audience
+    os.environ['JUPYTER_OAUTH2_CLIENT_ID'] = args.client_id
+    os.environ['JUPYTER_OAUTH2_AUTH_PROVIDER_URL'] = args.authurl
+    client = jupyter_oauth2_api.AuthClient()
+    #Any messages go to stderr so stdout only has the token
+    with contextlib.redirect_stdout(sys.stderr):
+        client.setup()
+        client.settings["token_store"] = True
+        client._check_settings()
+        refresh_token = ((record or {}).get("token_data") or {}).get("refresh_token")
+        if refresh_token:
+            try:
+                client.refresh(refresh_token)
+                return client.token_data
+            except Exception as e:
+                print("Refresh failed:", e)
+        if client.settings["auth_flow"] == 'client_credentials':
+            client.client_connect()
+        elif login:
+            client.device_connect(qrcode=False)
+        else:
+            raise(Exception("No valid token stored, login from a notebook or run without --no-login"))
+    return client.token_data
+
+def main(argv=None):
+    """
+    Entry point for the jupyter-oauth2-token command
+
+    Parameters
+    ----------
+    argv: list
+        command line arguments, default is sys.argv
+
+    Returns
+    -------
+    int
+        exit code
+    """
+    parser = argparse.ArgumentParser(prog='jupyter-oauth2-token',
+        description="Print a valid access token from the local token store, renewing it if needed")
+    parser.add_argument('--audience', default=os.getenv('JUPYTER_OAUTH2_API_AUDIENCE'),
+                        help="api audience url (default: $JUPYTER_OAUTH2_API_AUDIENCE)")
+    parser.add_argument('--client-id', default=os.getenv('JUPYTER_OAUTH2_CLIENT_ID'),
+                        help="client id the token was issued to (default: $JUPYTER_OAUTH2_CLIENT_ID)")
+    parser.add_argument('--authurl', default=os.getenv('JUPYTER_OAUTH2_AUTH_PROVIDER_URL'),
+                        help="auth provider url (default: $JUPYTER_OAUTH2_AUTH_PROVIDER_URL)")
+    parser.add_argument('--header', action='store_true',
+                        help="print an Authorization header instead of just the token")
+    parser.add_argument('--prefix', default=os.getenv('JUPYTER_OAUTH2_PREFIX', 'Bearer'),
+                        help="token prefix for --header (default: $JUPYTER_OAUTH2_PREFIX or Bearer)")
+    parser.add_argument('--leeway', type=int, default=60,
+                        help="renew tokens expiring within this many seconds (default: 60)")
+    parser.add_argument('--no-login', action='store_true',
+                        help="fail instead of starting a device login if there is no valid token")
+    args = parser.parse_args(argv)
+
+    if not args.audience:
+        parser.error("api audience required, pass --audience or set JUPYTER_OAUTH2_API_AUDIENCE")
+    if not args.client_id:
+        parser.error("client id required, pass --client-id or set JUPYTER_OAUTH2_CLIENT_ID")
+    if not args.authurl:
+        parser.error("auth provider url required, pass --authurl or set JUPYTER_OAUTH2_AUTH_PROVIDER_URL")
+
+    #Same file as the notebook login with these settings
+    path = jupyter_oauth2_store.token_path(args.audience, args.client_id, args.authurl)
+    record = jupyter_oauth2_store.read_json(path)
+    if _valid(record, args.leeway):
+        token_data = record["token_data"]
+    else:
+        try:
+            token_data = _renew(args, record, not args.no_login)
+        except Exception as e:
+            print("jupyter-oauth2-token:", e, file=sys.stderr)
+            return 1
+
+    if args.header:
+        print("Authorization: " + args.prefix + " " + token_data["access_token"])
+    else:
+        print(token_data["access_token"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,12 +3,21 @@ import setuptools
 setuptools.setup(
   name="jupyter_oauth2",
   # py_modules rather than packages, since we only have a few files
-  py_modules=['jupyter_oauth2', 'jupyter_oauth2_server', 'jupyter_oauth2_api'],
+  py_modules=['jupyter_oauth2', 'jupyter_oauth2_server', 'jupyter_oauth2_api', 'jupyter_oauth2_store',
+              'jupyter_oauth2_stream', 'jupyter_oauth2_token'],
   entry_points={
       'jupyter_serverproxy_servers': [
           # name = packagename:function_name
           'jupyter_oauth2 = jupyter_oauth2:setup_jupyter_oauth2',
+      ],
+      'console_scripts': [
+          # print the access token from the local token store for shell scripts
+          'jupyter-oauth2-token = jupyter_oauth2_token:main',
       ]
   },
   install_requires=['jupyter-server-proxy', 'pillow', 'qrcode'],
+  extras_require={
+      # faster json, streaming json parser and extra response compression (br, zstd) for API calls
+      'fast': ['orjson', 'brotli', 'zstandard', 'ijson'],
+  },
 )